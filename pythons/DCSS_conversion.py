@@ -1,14 +1,47 @@
-import dicom2nifti
-import dicom2nifti.settings as settings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import redirect_stdout
+import io
+import os
 from pathlib import Path
+import pydicom
+from pydicom.tag import Tag
 import shutil
+import SimpleITK as sitk
+import subprocess
+import sys
 import tempfile
-import zipfile
+from dicom_utils import extract_one_zip, resolve_temp_root
+from label_utils import link_or_copy
 
-def extract_dicoms_from_nested_structure(case_dir: Path, temp_extract_dir: Path) -> Path:
+# DICOM suffix spellings; str.endswith checks the whole tuple in one C call
+_DCM_SUFFIXES = ('.dcm', '.DCM', '.dicom', '.DICOM')
+
+# Header tags needed to pick and order the image series: SeriesInstanceUID,
+# Modality, Rows, ImagePositionPatient, ImageOrientationPatient, InstanceNumber
+_SERIES_PEEK_TAGS = [Tag(0x0020, 0x000E), Tag(0x0008, 0x0060), Tag(0x0028, 0x0010),
+                     Tag(0x0020, 0x0032), Tag(0x0020, 0x0037), Tag(0x0020, 0x0013)]
+_IMAGE_MODALITIES = {'MR', 'CT'}
+
+# Multi-threaded gzip for the .nii.gz output; None means fall back to zlib
+_PIGZ = shutil.which('pigz')
+
+
+def _walk_files(directory):
+    """
+    Yield every non-directory DirEntry under directory in a single scandir pass.
+    """
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk_files(entry.path)
+            else:
+                yield entry
+
+
+def extract_dicoms_from_nested_structure(case_dir: Path, temp_extract_dir: Path) -> list:
     """
     Navigate Duke's nested folder structure and extract DICOM files from zip archives.
-    Returns path to temp directory containing extracted DICOMs.
+    Returns the paths of the extracted DICOM files.
     
     Duke structure: case_dir/long-name-folder/zipfile.zip
     """
@@ -18,28 +51,30 @@ def extract_dicoms_from_nested_structure(case_dir: Path, temp_extract_dir: Path)
     subdirs = [d for d in case_dir.iterdir() if d.is_dir()]
     print(f"    Found {len(subdirs)} subdirectories")
     
+    # Collect every zip up front so they can be unpacked concurrently
+    zip_paths = []
     for subdir in subdirs:
         # Look for zip files directly in this subdirectory
         zip_files = list(subdir.glob("*.zip"))
         
         if zip_files:
             print(f"    Found {len(zip_files)} zip file(s) in {subdir.name}")
-            
-            for zip_file in zip_files:
-                try:
-                    # Extract to temp directory
-                    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-                        # List what's in the zip
-                        file_list = zip_ref.namelist()
-                        print(f"      Extracting {zip_file.name} ({len(file_list)} files inside)")
-                        
-                        zip_ref.extractall(temp_extract_dir)
-                        extracted_count += len(file_list)
-                    
-                    print(f"      ✓ Extracted: {zip_file.name}")
-                    
-                except Exception as e:
-                    print(f"      ✗ Warning: Could not extract {zip_file.name}: {e}")
+            zip_paths.extend(zip_files)
+    
+    # Extraction is I/O + zlib bound and releases the GIL, so threads overlap well.
+    # Each zip gets its own subfolder so same-named members of different zips
+    # are never written by two threads at once
+    if zip_paths:
+        with ThreadPoolExecutor(max_workers=min(8, len(zip_paths))) as executor:
+            results = list(executor.map(lambda iz: extract_one_zip(iz[1], temp_extract_dir / str(iz[0])),
+                                        enumerate(zip_paths)))
+        
+        for zip_file, member_count, err in results:
+            if err is None:
+                print(f"      ✓ Extracted: {zip_file.name} ({member_count} DICOM files)")
+                extracted_count += member_count
+            else:
+                print(f"      ✗ Warning: Could not extract {zip_file.name}: {err}")
     
     if extracted_count == 0:
         raise Exception("No files extracted from zip archives")
@@ -47,40 +82,164 @@ def extract_dicoms_from_nested_structure(case_dir: Path, temp_extract_dir: Path)
     print(f"    Total files extracted: {extracted_count}")
     
     # Check for DICOM files - they might not have .dcm extension!
-    # Try multiple patterns
+    # One scandir walk instead of a separate rglob per pattern
     dicom_files = []
-    dicom_files.extend(list(temp_extract_dir.rglob("*.dcm")))
-    dicom_files.extend(list(temp_extract_dir.rglob("*.DCM")))
-    dicom_files.extend(list(temp_extract_dir.rglob("*.dicom")))
-    dicom_files.extend(list(temp_extract_dir.rglob("*.DICOM")))
-    
-    # Also check for files with no extension (common for DICOMs)
-    all_files = list(temp_extract_dir.rglob("*"))
-    no_ext_files = [f for f in all_files if f.is_file() and not f.suffix]
+    no_ext_count = 0
+    all_names = []
+    for entry in _walk_files(temp_extract_dir):
+        name = entry.name
+        if len(all_names) < 10:
+            all_names.append(name)
+        if name.endswith(_DCM_SUFFIXES):
+            dicom_files.append(entry.path)
+        elif '.' not in name and entry.is_file(follow_symlinks=False):
+            # Files with no extension are common for DICOMs
+            dicom_files.append(entry.path)
+            no_ext_count += 1
     
-    if no_ext_files:
-        print(f"    Found {len(no_ext_files)} files with no extension (likely DICOMs)")
-        dicom_files.extend(no_ext_files)
+    if no_ext_count:
+        print(f"    Found {no_ext_count} files with no extension (likely DICOMs)")
     
     if not dicom_files:
         # List what we actually extracted
         print(f"    ERROR: No DICOM files found. Files extracted:")
-        for f in all_files[:10]:
-            print(f"      - {f.name} ({f.suffix if f.suffix else 'no extension'})")
+        for name in all_names:
+            suffix = os.path.splitext(name)[1]
+            print(f"      - {name} ({suffix if suffix else 'no extension'})")
         raise Exception("No DICOM files found after extraction")
     
     print(f"    ✓ Found {len(dicom_files)} DICOM files")
-    return temp_extract_dir
+    return dicom_files
+
+
+def _slice_position(ds) -> float:
+    """
+    Position of a slice along its normal (ImagePositionPatient projected on
+    the cross product of the ImageOrientationPatient row/column vectors).
+    Falls back to InstanceNumber when the geometry tags are missing.
+    """
+    ipp = ds.get('ImagePositionPatient')
+    iop = ds.get('ImageOrientationPatient')
+    if ipp is None or iop is None or len(iop) != 6:
+        return float(ds.get('InstanceNumber', 0) or 0)
+    
+    r = [float(v) for v in iop[:3]]
+    c = [float(v) for v in iop[3:]]
+    normal = (r[1] * c[2] - r[2] * c[1], r[2] * c[0] - r[0] * c[2], r[0] * c[1] - r[1] * c[0])
+    return sum(n * float(p) for n, p in zip(normal, ipp))
+
+
+def select_primary_series(dicom_files: list) -> list:
+    """
+    Group DICOM files by SeriesInstanceUID using a header-only peek and
+    return the files of the largest MR/CT image series (localizers, SRs and
+    secondary captures are dropped), sorted by slice position.
+    Pixel data is never read here.
+    """
+    series = {}
+    for path in dicom_files:
+        try:
+            ds = pydicom.dcmread(path, stop_before_pixels=True,
+                                 specific_tags=_SERIES_PEEK_TAGS, force=True)
+        except Exception:
+            continue
+        
+        uid = ds.get('SeriesInstanceUID')
+        if uid is None or 'Rows' not in ds:
+            continue  # Not an image slice
+        
+        entry = series.setdefault(uid, {'modality': ds.get('Modality', ''), 'slices': []})
+        entry['slices'].append((_slice_position(ds), path))
+    
+    if not series:
+        raise Exception("No DICOM image series found in extracted files")
+    
+    candidates = [s for s in series.values() if s['modality'] in _IMAGE_MODALITIES] or list(series.values())
+    best = max(candidates, key=lambda s: len(s['slices']))
+    
+    if len(series) > 1:
+        print(f"    Found {len(series)} series, using {best['modality'] or 'unknown'} series with {len(best['slices'])} slices")
+    
+    best['slices'].sort(key=lambda item: item[0])
+    return [path for _, path in best['slices']]
 
 
-def process_duke_dicoms_proper(base_path: Path):
+def _write_nifti_gz(image, vol_output: str, temp_dir: str, threads: int = 1):
+    """
+    Write image as .nii.gz. With pigz available and more than one thread to
+    give it, write an uncompressed .nii to temp_dir and compress it with
+    `threads` pigz threads; otherwise let SimpleITK compress with zlib
+    directly (single-threaded pigz would only add the raw write and read).
     """
-    Process Duke dataset using the proper dicom2nifti library:
+    if _PIGZ is None or threads < 2:
+        sitk.WriteImage(image, vol_output, useCompression=True)
+        return
+    
+    raw_path = os.path.join(temp_dir, "volume.nii")
+    sitk.WriteImage(image, raw_path)
+    with open(vol_output, 'wb') as dst:
+        subprocess.run([_PIGZ, '-p', str(threads), '-6', '-c', raw_path], stdout=dst, check=True)
+
+
+def _process_one_case(case_dir: Path, seg_file: str, vol_output: str, label_output: str,
+                      compress_threads: int = 1, temp_root: str = None):
+    """
+    Extract, convert and copy a single case. Runs inside a worker process.
+    Returns (case_id, status, error, log) where status is 'success' or
+    'error' and log is the case's buffered progress output.
+    """
+    case_id = case_dir.name
+    
+    # Buffer this case's progress lines so the driver can emit them in one
+    # write and parallel workers don't interleave their output
+    log = io.StringIO()
+    
+    # Create temporary directory for this case (RAM-backed when available)
+    temp_dir = tempfile.mkdtemp(dir=temp_root)
+    
+    try:
+        with redirect_stdout(log):
+            # Step 1: Extract DICOMs from nested zip structure
+            dicom_files = extract_dicoms_from_nested_structure(case_dir, Path(temp_dir))
+            
+            # Step 2: Pick the image series from headers only, already sorted
+            # by slice position, so no second directory walk is needed
+            series_files = select_primary_series(dicom_files)
+            
+            # Step 3: Read and write with SimpleITK (native DICOM decode and
+            # zlib compression); reorient to LAS like dicom2nifti's reorient_nifti
+            reader = sitk.ImageSeriesReader()
+            reader.SetFileNames(series_files)
+            image = sitk.DICOMOrient(reader.Execute(), 'LAS')
+            _write_nifti_gz(image, vol_output, temp_dir, compress_threads)
+            
+            # Step 4: Copy segmentation file
+            link_or_copy(seg_file, label_output, shutil.copy2)
+        return case_id, 'success', None, log.getvalue()
+    
+    except Exception as e:
+        return case_id, 'error', str(e), log.getvalue()
+    
+    finally:
+        # Clean up temporary directory
+        try:
+            shutil.rmtree(temp_dir)
+        except:
+            pass
+
+
+def process_duke_dicoms_proper(base_path: Path, max_workers: int = None, temp_root: str = None):
+    """
+    Process Duke dataset using SimpleITK's DICOM series reader:
     1. Find all case directories with DICOM files
     2. Extract DICOMs from nested zip structure
-    3. Convert DICOMs to NIfTI using dicom2nifti library
+    3. Convert DICOMs to NIfTI using SimpleITK
     4. Match with segmentation files
     5. Organize into /volumes and /labels folders
+    
+    Cases are independent, so extraction + conversion runs in a process pool
+    (max_workers defaults to os.cpu_count()). Extraction goes to temp_root,
+    defaulting to /dev/shm when available.
     """
     base_path = Path(base_path)
     imaging_dir = base_path / "DukeCSpineSeg_imaging_files" / "case_image"
@@ -94,13 +253,15 @@ def process_duke_dicoms_proper(base_path: Path):
     labels_dir.mkdir(exist_ok=True)
     
     print("="*80)
-    print("DUKE DATASET: DICOM TO NIFTI CONVERSION (using dicom2nifti library)")
+    print("DUKE DATASET: DICOM TO NIFTI CONVERSION (using SimpleITK)")
     print("="*80)
     print(f"Base directory: {base_path}")
     print(f"Imaging source: {imaging_dir}")
     print(f"Segmentation source: {seg_dir}")
     print(f"Output volumes: {volumes_dir}")
     print(f"Output labels: {labels_dir}")
+    temp_root = resolve_temp_root(temp_root)
+    print(f"Temp extraction dir: {temp_root or tempfile.gettempdir()}")
     print()
     
     # Check directories exist
@@ -112,10 +273,6 @@ def process_duke_dicoms_proper(base_path: Path):
         print(f"ERROR: Segmentation directory not found: {seg_dir}")
         return
     
-    # Configure dicom2nifti settings
-    # Allow single slices (Duke might have some)
-    settings.disable_validate_slicecount()
-    
     # Get all case directories
     case_dirs = sorted([d for d in imaging_dir.iterdir() if d.is_dir()])
     
@@ -123,32 +280,38 @@ def process_duke_dicoms_proper(base_path: Path):
     print()
     
     # Get all segmentation files
-    seg_files = sorted(seg_dir.glob("*.nii.gz"))
-    seg_dict = {}
-    for seg_file in seg_files:
-        # Extract case ID (e.g., "593973-000001")
-        case_id = seg_file.name.split('_')[0]
-        seg_dict[case_id] = seg_file
-    
-    print(f"Found {len(seg_files)} segmentation files")
+    # {case_id: path} from one directory listing; case ID is the name
+    # before the first underscore (e.g., "593973-000001")
+    seg_dict = {e.name.split('_', 1)[0]: e.path
+                for e in os.scandir(seg_dir) if e.name.endswith(".nii.gz")}
+    
+    print(f"Found {len(seg_dict)} segmentation files")
     print()
     
+    # Only cases with a segmentation are processed; filter once up front
+    pending_cases = [d for d in case_dirs if d.name in seg_dict]
+    total_with_seg = len(pending_cases)
+    
+    # One directory listing per output dir instead of a stat() per case
+    done_vols = {e.name for e in os.scandir(volumes_dir)}
+    done_labels = {e.name for e in os.scandir(labels_dir)}
+    
+    # Plain strings for the per-case paths; no Path objects in the loop
+    volumes_dir_str = str(volumes_dir)
+    labels_dir_str = str(labels_dir)
+    
     # Check how many are already processed
     already_done = 0
-    for case_dir in case_dirs:
+    for case_dir in pending_cases:
         case_id = case_dir.name
-        if case_id not in seg_dict:
-            continue
-        vol_output = volumes_dir / f"{case_id}_0000.nii.gz"
-        label_output = labels_dir / f"{case_id}.nii.gz"
-        if vol_output.exists() and label_output.exists():
+        if f"{case_id}_0000.nii.gz" in done_vols and f"{case_id}.nii.gz" in done_labels:
             already_done += 1
     
-    remaining = len([d for d in case_dirs if d.name in seg_dict]) - already_done
+    remaining = total_with_seg - already_done
     
     print("="*80)
     print("RESUME STATUS:")
-    print(f"  Total cases: {len([d for d in case_dirs if d.name in seg_dict])}")
+    print(f"  Total cases: {total_with_seg}")
     print(f"  Already processed: {already_done}")
     print(f"  Remaining: {remaining}")
     print("="*80)
@@ -166,94 +329,66 @@ def process_duke_dicoms_proper(base_path: Path):
     error_count = 0
     skipped_count = 0  # Already processed
     case_number = 0  # Track which case we're on
+    work_items = []  # Cases that still need extraction + conversion
     
-    for case_dir in case_dirs:
+    for case_dir in pending_cases:
         case_id = case_dir.name
-        
-        # Check if segmentation exists
-        if case_id not in seg_dict:
-            continue
-        
-        case_number += 1
-        
-        print(f"Processing case {case_number}/{len([d for d in case_dirs if d.name in seg_dict])}: {case_id}")
-        
         seg_file = seg_dict[case_id]
         
         # Output paths - ADD _0000 to volume to match universal convention
-        vol_output = volumes_dir / f"{case_id}_0000.nii.gz"  # <-- Added _0000
-        label_output = labels_dir / f"{case_id}.nii.gz"
+        vol_name = f"{case_id}_0000.nii.gz"  # <-- Added _0000
+        label_name = f"{case_id}.nii.gz"
+        vol_output = f"{volumes_dir_str}{os.sep}{vol_name}"
+        label_output = f"{labels_dir_str}{os.sep}{label_name}"
+        vol_done = vol_name in done_vols
+        label_done = label_name in done_labels
         
         # Skip if already processed
-        if vol_output.exists() and label_output.exists():
-            print(f"  ✓ Already processed, skipping")
+        if vol_done and label_done:
             success_count += 1
-            print()
             continue
         
         # Also skip if only volume exists (partial processing)
-        if vol_output.exists() and not label_output.exists():
-            print(f"  ⚠ Partial processing detected - volume exists, copying label only")
+        if vol_done and not label_done:
+            print(f"  ⚠ {case_id}: partial processing detected - volume exists, copying label only")
             try:
-                shutil.copy2(seg_file, label_output)
-                print(f"  ✓ Segmentation copied: {label_output.name}")
+                link_or_copy(seg_file, label_output, shutil.copy2)
+                done_labels.add(label_name)
+                print(f"  ✓ Segmentation copied: {label_name}")
                 success_count += 1
-                print()
-                continue
             except Exception as e:
                 print(f"  ✗ ERROR copying label: {e}")
                 error_count += 1
-                print()
-                continue
-        
-        # Create temporary directory for this case
-        temp_dir = tempfile.mkdtemp()
+            print()
+            continue
         
-        try:
-            # Step 1: Extract DICOMs from nested zip structure
-            print(f"  Extracting DICOMs from nested structure...")
-            dicom_dir = extract_dicoms_from_nested_structure(case_dir, Path(temp_dir))
-            
-            # Step 2: Convert using dicom2nifti library
-            print(f"  Converting DICOMs to NIfTI...")
-            
-            # dicom2nifti.dicom_series_to_nifti returns a dictionary with:
-            # - 'NII_FILE': path to created nifti file
-            # - 'NIFTI': the nibabel image object
-            # - 'BVAL_FILE': path to bval file (for DTI, if present)
-            # - 'BVEC_FILE': path to bvec file (for DTI, if present)
-            
-            result = dicom2nifti.dicom_series_to_nifti(
-                str(dicom_dir),
-                str(vol_output),
-                reorient_nifti=True  # Standardize to LAS orientation
-            )
-            
-            if result and 'NII_FILE' in result:
-                print(f"  ✓ Volume converted: {vol_output.name}")
-                
-                # Step 3: Copy segmentation file
-                shutil.copy2(seg_file, label_output)
-                print(f"  ✓ Segmentation copied: {label_output.name}")
-                
+        work_items.append((case_dir, seg_file, vol_output, label_output))
+    
+    # Cases are independent (own temp dir, own output), so convert them in parallel
+    workers = max_workers or os.cpu_count()
+    # Share the cores between case workers and each worker's pigz threads
+    compress_threads = max(1, os.cpu_count() // workers)
+    print(f"Converting {len(work_items)} cases with {workers} workers...")
+    if _PIGZ and compress_threads > 1:
+        print(f"Compressing output with pigz ({compress_threads} threads per case)")
+    print()
+    
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_process_one_case, *item, compress_threads, temp_root) for item in work_items]
+        for future in as_completed(futures):
+            case_id, status, err, log = future.result()
+            case_number += 1
+            if status == 'success':
+                done_vols.add(f"{case_id}_0000.nii.gz")
+                done_labels.add(f"{case_id}.nii.gz")
+                status_line = f"[{case_number}/{len(work_items)}] ✓ {case_id}: volume converted, segmentation copied"
                 success_count += 1
             else:
-                print(f"  ✗ ERROR: Conversion returned no output")
+                status_line = f"[{case_number}/{len(work_items)}] ✗ ERROR processing {case_id}: {err}"
                 error_count += 1
-            
-            print()
-            
-        except Exception as e:
-            print(f"  ✗ ERROR processing {case_id}: {e}")
-            error_count += 1
-            print()
-        
-        finally:
-            # Clean up temporary directory
-            try:
-                shutil.rmtree(temp_dir)
-            except:
-                pass
+            # One write per case: status line followed by the worker's detail
+            sys.stdout.write(f"{status_line}\n{log}")
+    print()
     
     # Summary
     print("="*80)
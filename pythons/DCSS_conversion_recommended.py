@@ -1,36 +1,132 @@
 import pandas as pd
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import redirect_stdout
+import functools
+import io
+from itertools import islice
+import os
 from pathlib import Path
 import subprocess
+import sys
 import tempfile
 import shutil
-import zipfile
+from dicom_utils import extract_one_zip, resolve_temp_root
+from label_utils import link_or_copy
+
 
 def extract_dicoms_from_case(case_dir: Path, temp_dir: Path) -> bool:
     """
-    Extract DICOMs from Duke's nested zip structure.
+    Extract DICOMs from Duke's nested zip structure into temp_dir (flat).
     Returns True if extraction successful.
     """
     subdirs = [d for d in case_dir.iterdir() if d.is_dir()]
     
+    zip_paths = [z for subdir in subdirs for z in subdir.glob("*.zip")]
+    if not zip_paths:
+        return False
+    
+    # Unpack all zips of the case concurrently; zlib releases the GIL.
+    # The zip index prefix keeps same-named slices from different zips apart.
+    with ThreadPoolExecutor(max_workers=min(8, len(zip_paths))) as executor:
+        results = list(executor.map(lambda iz: extract_one_zip(iz[1], temp_dir, f"{iz[0]}_"),
+                                    enumerate(zip_paths)))
+    
     extracted_any = False
-    for subdir in subdirs:
-        zip_files = list(subdir.glob("*.zip"))
-        
-        for zip_file in zip_files:
-            try:
-                with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-                    zip_ref.extractall(temp_dir)
-                extracted_any = True
-            except Exception as e:
-                print(f"      Warning: Could not extract {zip_file.name}: {e}")
+    for zip_file, member_count, err in results:
+        if err is not None:
+            print(f"      Warning: Could not extract {zip_file.name}: {err}")
+        extracted_any = extracted_any or member_count > 0
     
     return extracted_any
 
 
-def convert_duke_with_dcm2niix(base_path: Path):
+@functools.lru_cache(maxsize=1)
+def _dcm2niix_version():
+    """
+    Resolve the dcm2niix binary once and probe its version.
+    Returns (absolute_path, version_string); raises FileNotFoundError if
+    dcm2niix is not on PATH.
+    """
+    dcm2niix_bin = shutil.which('dcm2niix')
+    if dcm2niix_bin is None:
+        raise FileNotFoundError('dcm2niix')
+    result = subprocess.run([dcm2niix_bin, '-v'], capture_output=True, text=True)
+    return dcm2niix_bin, result.stdout.split()[0] if result.stdout else 'installed'
+
+
+def _convert_case(dcm2niix_bin: str, case_root: Path, out_dir: Path) -> str:
+    """
+    Run dcm2niix (absolute path dcm2niix_bin, so no PATH search per call)
+    over one staged case, writing into its own empty out_dir.
+    Returns the produced .nii.gz path; raises if nothing was written.
+    """
+    # dcm2niix options:
+    # -b n: don't create BIDS sidecar
+    # -z y: compress to .nii.gz
+    # -f %s: series number (out_dir already identifies the case)
+    # -o: output directory
+    # -s y: single file mode (merge 2D slices)
+    
+    cmd = [
+        dcm2niix_bin,
+        '-b', 'n',           # No BIDS sidecar
+        '-z', 'y',           # Compress
+        '-f', '%s',          # Series naming
+        '-o', str(out_dir),  # Per-case output dir
+        '-s', 'y',           # Single file
+        str(case_root)
+    ]
+    
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+    
+    # dcm2niix exits nonzero when any series fails, even if the main one was
+    # written, so judge by what landed in out_dir. If a case produced several
+    # series, keep the largest file (the main image series)
+    produced = max((e for e in os.scandir(out_dir) if e.name.endswith(".nii.gz")),
+                   key=lambda e: e.stat().st_size, default=None)
+    
+    if produced is None:
+        if result.returncode != 0:
+            raise Exception(f"dcm2niix conversion failed: {result.stderr}")
+        raise Exception("No NIfTI file created by dcm2niix")
+    
+    return produced.path
+
+
+def _stage_and_convert_case(case_dir: Path, work_root: Path, dcm2niix_bin: str):
+    """
+    Extract one case into work_root/cases/<case_id>/ and convert it into
+    work_root/out/<case_id>/. Runs inside a worker process.
+    Returns (case_id, produced, error, log) where produced is the .nii.gz
+    path (None on error) and log is the case's buffered warning output.
+    """
+    case_id = case_dir.name
+    log = io.StringIO()  # Buffered so parallel workers don't interleave output
+    try:
+        with redirect_stdout(log):
+            extracted = extract_dicoms_from_case(case_dir, work_root / "cases" / case_id)
+        if not extracted:
+            return case_id, None, "No DICOMs extracted", log.getvalue()
+        
+        out_dir = work_root / "out" / case_id
+        out_dir.mkdir(parents=True)
+        return case_id, _convert_case(dcm2niix_bin, work_root / "cases" / case_id, out_dir), None, log.getvalue()
+    except subprocess.TimeoutExpired:
+        return case_id, None, "dcm2niix timeout", log.getvalue()
+    except Exception as e:
+        return case_id, None, str(e), log.getvalue()
+
+
+def convert_duke_with_dcm2niix(base_path: Path, max_workers: int = None, max_staged: int = 32,
+                               temp_root: str = None):
     """
     Convert Duke dataset using dcm2niix CLI tool.
-    Extracts from zips, converts, and renames sequentially.
+    Cases are extracted and converted in a process pool (max_workers
+    defaults to os.cpu_count()), each with its own dcm2niix run and output
+    dir, then renamed. At most max_staged cases are staged at once under
+    temp_root, defaulting to /dev/shm when available, and each case's temp
+    files are removed as soon as it finishes; lower max_staged if the RAM
+    disk is small (keeping it at least max_workers keeps every worker busy).
     """
     base_path = Path(base_path)
     imaging_dir = base_path / "DukeCSpineSeg_imaging_files" / "case_image"
@@ -51,6 +147,8 @@ def convert_duke_with_dcm2niix(base_path: Path):
     print(f"Segmentation source: {seg_dir}")
     print(f"Output volumes: {volumes_dir}")
     print(f"Output labels: {labels_dir}")
+    temp_root = resolve_temp_root(temp_root)
+    print(f"Temp extraction dir: {temp_root or tempfile.gettempdir()}")
     print()
     
     # Validate directories
@@ -64,8 +162,8 @@ def convert_duke_with_dcm2niix(base_path: Path):
     
     # Check dcm2niix is installed
     try:
-        result = subprocess.run(['dcm2niix', '-v'], capture_output=True, text=True)
-        print(f"Using dcm2niix: {result.stdout.split()[0] if result.stdout else 'installed'}")
+        dcm2niix_bin, dcm2niix_version = _dcm2niix_version()
+        print(f"Using dcm2niix: {dcm2niix_version} ({dcm2niix_bin})")
     except FileNotFoundError:
         print("ERROR: dcm2niix not found. Please install it:")
         print("  Windows: Download from https://github.com/rordenlab/dcm2niix/releases")
@@ -78,27 +176,37 @@ def convert_duke_with_dcm2niix(base_path: Path):
     case_dirs = sorted([d for d in imaging_dir.iterdir() if d.is_dir()])
     
     # Get all segmentation files
-    seg_files = sorted(seg_dir.glob("*.nii.gz"))
-    seg_dict = {}
-    for seg_file in seg_files:
-        case_id = seg_file.name.split('_')[0]
-        seg_dict[case_id] = seg_file
+    # {case_id: path} from one directory listing; case ID is the name
+    # before the first underscore (e.g., "593973-000001")
+    seg_dict = {e.name.split('_', 1)[0]: e.path
+                for e in os.scandir(seg_dir) if e.name.endswith(".nii.gz")}
     
     print(f"Found {len(case_dirs)} case directories")
-    print(f"Found {len(seg_files)} segmentation files")
+    print(f"Found {len(seg_dict)} segmentation files")
     print()
     
+    # Only cases with a segmentation are processed; filter once up front
+    pending_cases = [d for d in case_dirs if d.name in seg_dict]
+    total_with_seg = len(pending_cases)
+    
+    # One directory listing per output dir instead of a stat() per case
+    done_vols = {e.name for e in os.scandir(volumes_dir)}
+    done_labels = {e.name for e in os.scandir(labels_dir)}
+    
+    # Plain strings for the per-case paths; no Path objects in the loop
+    volumes_dir_str = str(volumes_dir)
+    labels_dir_str = str(labels_dir)
+    
     # Check resume status
-    already_done = sum(1 for d in case_dirs 
-                      if d.name in seg_dict 
-                      and (volumes_dir / f"{d.name}_0000.nii.gz").exists()
-                      and (labels_dir / f"{d.name}.nii.gz").exists())
+    already_done = sum(1 for d in pending_cases 
+                      if f"{d.name}_0000.nii.gz" in done_vols
+                      and f"{d.name}.nii.gz" in done_labels)
     
-    remaining = len([d for d in case_dirs if d.name in seg_dict]) - already_done
+    remaining = total_with_seg - already_done
     
     print("="*80)
     print("RESUME STATUS:")
-    print(f"  Total cases: {len([d for d in case_dirs if d.name in seg_dict])}")
+    print(f"  Total cases: {total_with_seg}")
     print(f"  Already processed: {already_done}")
     print(f"  Remaining: {remaining}")
     print("="*80)
@@ -114,122 +222,90 @@ def convert_duke_with_dcm2niix(base_path: Path):
     skipped_count = 0
     case_number = 0
     
-    for case_dir in case_dirs:
+    work_items = []  # Cases that still need extraction + conversion
+    
+    for case_dir in pending_cases:
         case_id = case_dir.name
-        
-        if case_id not in seg_dict:
-            continue
-        
-        case_number += 1
-        
-        print(f"[{case_number}/{len([d for d in case_dirs if d.name in seg_dict])}] Processing: {case_id}")
-        
         seg_file = seg_dict[case_id]
         
         # Output paths with _0000 suffix for volumes
-        vol_output = volumes_dir / f"{case_id}_0000.nii.gz"
-        label_output = labels_dir / f"{case_id}.nii.gz"
+        vol_name = f"{case_id}_0000.nii.gz"
+        label_name = f"{case_id}.nii.gz"
+        vol_output = f"{volumes_dir_str}{os.sep}{vol_name}"
+        label_output = f"{labels_dir_str}{os.sep}{label_name}"
+        vol_done = vol_name in done_vols
+        label_done = label_name in done_labels
         
         # Skip if already processed
-        if vol_output.exists() and label_output.exists():
-            print(f"  ✓ Already processed, skipping")
+        if vol_done and label_done:
             skipped_count += 1
-            print()
             continue
         
         # Handle partial processing
-        if vol_output.exists() and not label_output.exists():
+        if vol_done and not label_done:
             try:
-                shutil.copy2(seg_file, label_output)
-                print(f"  ✓ Partial: copied segmentation only")
+                link_or_copy(seg_file, label_output, shutil.copy2)
+                done_labels.add(label_name)
+                print(f"  ✓ Partial: copied segmentation only for {case_id}")
                 skipped_count += 1
-                print()
-                continue
             except Exception as e:
-                print(f"  ✗ ERROR copying label: {e}")
+                print(f"  ✗ ERROR copying label for {case_id}: {e}")
                 error_count += 1
-                print()
-                continue
-        
-        # Create temp directory
-        temp_dir = tempfile.mkdtemp()
+            continue
         
-        try:
-            # Extract DICOMs
-            print(f"  Extracting DICOMs...")
-            if not extract_dicoms_from_case(case_dir, Path(temp_dir)):
-                raise Exception("No DICOMs extracted")
-            
-            # Convert using dcm2niix
-            print(f"  Converting with dcm2niix...")
-            
-            # dcm2niix options:
-            # -b n: don't create BIDS sidecar
-            # -z y: compress to .nii.gz
-            # -f %i: filename pattern (use instance UID - we'll rename after)
-            # -o: output directory
-            # -s y: single file mode (merge 2D slices)
-            
-            cmd = [
-                'dcm2niix',
-                '-b', 'n',           # No BIDS sidecar
-                '-z', 'y',           # Compress
-                '-f', '%p_%s',       # Patient_Series naming
-                '-o', str(volumes_dir),  # Output to volumes dir
-                '-s', 'y',           # Single file
-                str(temp_dir)        # Input directory
-            ]
-            
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
-            
-            if result.returncode != 0:
-                print(f"  ✗ dcm2niix failed: {result.stderr}")
-                raise Exception("dcm2niix conversion failed")
-            
-            # dcm2niix creates files with various names - find the newest .nii.gz
-            nifti_files = sorted(volumes_dir.glob("*.nii.gz"), key=lambda x: x.stat().st_mtime)
-            
-            if not nifti_files:
-                raise Exception("No NIfTI file created by dcm2niix")
-            
-            # Get the most recently created file
-            newest_nifti = nifti_files[-1]
-            
-            # Rename to our standard naming
-            if newest_nifti != vol_output:
-                shutil.move(str(newest_nifti), str(vol_output))
-            
-            print(f"  ✓ Volume converted: {vol_output.name}")
-            
-            # Copy segmentation
-            shutil.copy2(seg_file, label_output)
-            print(f"  ✓ Segmentation copied: {label_output.name}")
-            
-            success_count += 1
-            print()
-            
-        except subprocess.TimeoutExpired:
-            print(f"  ✗ ERROR: dcm2niix timeout")
-            error_count += 1
-            print()
-        except Exception as e:
-            print(f"  ✗ ERROR: {e}")
-            error_count += 1
-            print()
-        finally:
-            # Cleanup temp directory
-            try:
-                shutil.rmtree(temp_dir)
-            except:
-                pass
-            
-            # Cleanup any intermediate files dcm2niix might have created
-            for f in volumes_dir.glob("*_*_*.nii.gz"):
-                if f != vol_output:
-                    try:
-                        f.unlink()
-                    except:
-                        pass
+        work_items.append((case_dir, seg_file, vol_output, label_output))
+    
+    # Extract and convert cases in parallel. A new case is submitted as each
+    # one finishes, so at most max_staged cases hold temp space at once and
+    # no worker waits on the slowest case of a batch. Each case gets its own
+    # dcm2niix output dir, since one run over many cases names every output
+    # after the shared parent folder
+    print(f"Converting {len(work_items)} cases with {max_workers or os.cpu_count()} workers, "
+          f"at most {max_staged} cases staged at a time...")
+    print()
+    
+    work_root = Path(tempfile.mkdtemp(dir=temp_root))
+    pending = iter(work_items)
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            in_flight = {executor.submit(_stage_and_convert_case, item[0], work_root, dcm2niix_bin): item
+                         for item in islice(pending, max_staged)}
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    _, seg_file, vol_output, label_output = in_flight.pop(future)
+                    case_id, produced, err, stage_log = future.result()
+                    if err is None:
+                        try:
+                            # Rename to our standard naming, then copy segmentation
+                            shutil.move(produced, vol_output)
+                            link_or_copy(seg_file, label_output, shutil.copy2)
+                        except Exception as e:
+                            err = str(e)
+                    
+                    # Free this case's staged DICOMs and leftover dcm2niix outputs
+                    shutil.rmtree(work_root / "cases" / case_id, ignore_errors=True)
+                    shutil.rmtree(work_root / "out" / case_id, ignore_errors=True)
+                    
+                    next_item = next(pending, None)
+                    if next_item is not None:
+                        in_flight[executor.submit(_stage_and_convert_case, next_item[0], work_root,
+                                                  dcm2niix_bin)] = next_item
+                    
+                    case_number += 1
+                    if err is None:
+                        done_vols.add(f"{case_id}_0000.nii.gz")
+                        done_labels.add(f"{case_id}.nii.gz")
+                        line = f"[{case_number}/{len(work_items)}] ✓ {case_id}: volume converted, segmentation copied\n"
+                        success_count += 1
+                    else:
+                        line = f"[{case_number}/{len(work_items)}] ✗ ERROR {case_id}: {err}\n"
+                        error_count += 1
+                    # One write per case so worker output stays with its case
+                    sys.stdout.write(line + stage_log)
+    finally:
+        shutil.rmtree(work_root, ignore_errors=True)
+    print()
     
     # Summary
     print("="*80)
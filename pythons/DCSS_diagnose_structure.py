@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 def explore_duke_structure(base_path: Path, case_limit: int = 3):
@@ -28,50 +29,59 @@ def explore_duke_structure(base_path: Path, case_limit: int = 3):
         print("="*80)
         
         # Level 1: Direct children
-        level1_items = list(case_dir.iterdir())
+        # os.scandir entries cache their type, so is_dir/is_file need no extra stat
+        level1_items = list(os.scandir(case_dir))
         print(f"\nLevel 1 ({len(level1_items)} items):")
         for item in level1_items:
-            item_type = "DIR" if item.is_dir() else "FILE"
-            size = f"{item.stat().st_size:,} bytes" if item.is_file() else ""
+            is_file = item.is_file()
+            item_type = "FILE" if is_file else "DIR"
+            size = f"{item.stat().st_size:,} bytes" if is_file else ""
             print(f"  [{item_type}] {item.name} {size}")
         
         # Level 2: Explore subdirectories
         subdirs = [d for d in level1_items if d.is_dir()]
         for subdir in subdirs:
-            level2_items = list(subdir.iterdir())
+            level2_items = list(os.scandir(subdir.path))
             print(f"\n  Level 2 in '{subdir.name}' ({len(level2_items)} items):")
             for item in level2_items:
-                item_type = "DIR" if item.is_dir() else "FILE"
-                size = f"{item.stat().st_size:,} bytes" if item.is_file() else ""
-                ext = item.suffix if item.is_file() else ""
+                is_file = item.is_file()
+                item_type = "FILE" if is_file else "DIR"
+                size = f"{item.stat().st_size:,} bytes" if is_file else ""
+                ext = os.path.splitext(item.name)[1] if is_file else ""
                 print(f"    [{item_type}] {item.name} {ext} {size}")
             
             # Level 3: Go deeper if directories
             level2_subdirs = [d for d in level2_items if d.is_dir()]
             for subdir2 in level2_subdirs:
-                level3_items = list(subdir2.iterdir())
-                print(f"\n      Level 3 in '{subdir2.name}' ({len(level3_items)} items):")
-                for item in level3_items[:10]:  # Limit to first 10
-                    item_type = "DIR" if item.is_dir() else "FILE"
-                    size = f"{item.stat().st_size:,} bytes" if item.is_file() else ""
-                    ext = item.suffix if item.is_file() else ""
-                    print(f"        [{item_type}] {item.name} {ext} {size}")
+                # Single pass: format only the first 10 entries, just tally the rest
+                shown_lines = []
+                file_types = {}
+                level3_count = 0
+                with os.scandir(subdir2.path) as entries:
+                    for item in entries:
+                        level3_count += 1
+                        is_file = item.is_file()
+                        ext = os.path.splitext(item.name)[1] if is_file else ""
+                        if is_file:
+                            key = ext if ext else "no_extension"
+                            file_types[key] = file_types.get(key, 0) + 1
+                        if level3_count <= 10:  # Limit to first 10
+                            item_type = "FILE" if is_file else "DIR"
+                            size = f"{item.stat().st_size:,} bytes" if is_file else ""
+                            shown_lines.append(f"        [{item_type}] {item.name} {ext} {size}")
                 
-                if len(level3_items) > 10:
-                    print(f"        ... and {len(level3_items) - 10} more items")
+                print(f"\n      Level 3 in '{subdir2.name}' ({level3_count} items):")
+                for line in shown_lines:
+                    print(line)
+                
+                if level3_count > 10:
+                    print(f"        ... and {level3_count - 10} more items")
                 
                 # Check what file types are present
-                if level3_items:
-                    file_types = {}
-                    for item in level3_items:
-                        if item.is_file():
-                            ext = item.suffix if item.suffix else "no_extension"
-                            file_types[ext] = file_types.get(ext, 0) + 1
-                    
-                    if file_types:
-                        print(f"\n      File type summary:")
-                        for ext, count in sorted(file_types.items()):
-                            print(f"        {ext}: {count} files")
+                if file_types:
+                    print(f"\n      File type summary:")
+                    for ext, count in sorted(file_types.items()):
+                        print(f"        {ext}: {count} files")
         
         print("\n")
     
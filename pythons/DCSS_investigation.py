@@ -1,6 +1,7 @@
 import nibabel as nib
 import numpy as np
 from pathlib import Path
+from label_utils import label_histogram
 
 def diagnose_segmentations(labels_dir: Path, num_samples: int = 5):
     """
@@ -38,7 +39,9 @@ def diagnose_segmentations(labels_dir: Path, num_samples: int = 5):
         print(f"File size: {size_bytes:,} bytes ({size_kb:.2f} KB, {size_mb:.2f} MB)")
         
         try:
-            # Load and analyze
+            # Load and analyze - the histogram below reads every voxel anyway,
+            # so read the stored dtype straight from the file (.nii.gz inflated
+            # in-stream, .nii memory-mapped) rather than a float64 get_fdata copy
             img = nib.load(str(label_file))
             data = np.asarray(img.dataobj)
             
@@ -46,12 +49,12 @@ def diagnose_segmentations(labels_dir: Path, num_samples: int = 5):
             print(f"Data type: {data.dtype}")
             print(f"Total voxels: {data.size:,}")
             
-            # Check unique values
-            unique_labels = np.unique(data)
+            # One histogram pass gives unique labels, non-zero count and per-label counts
+            unique_labels, label_counts = label_histogram(data)
             print(f"Unique labels: {unique_labels.tolist()}")
             
             # Count non-zero voxels
-            non_zero = np.count_nonzero(data)
+            non_zero = int(label_counts[unique_labels != 0].sum())
             percent_labeled = (non_zero / data.size) * 100
             print(f"Non-zero voxels: {non_zero:,} ({percent_labeled:.2f}%)")
             
@@ -62,11 +65,10 @@ def diagnose_segmentations(labels_dir: Path, num_samples: int = 5):
             # Check label distribution
             if len(unique_labels) > 1:
                 print("\nLabel distribution:")
-                for label in unique_labels:
+                for label, count in zip(unique_labels, label_counts):
                     if label == 0:
                         continue
-                    count = np.sum(data == label)
-                    print(f"  Label {int(label)}: {count:,} voxels")
+                    print(f"  Label {int(label)}: {int(count):,} voxels")
             
             # Check affine/spacing
             print(f"\nVoxel spacing: {img.header.get_zooms()[:3]}")
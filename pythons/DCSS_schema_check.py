@@ -1,9 +1,59 @@
+from concurrent.futures import ProcessPoolExecutor
+import sys
 import nibabel as nib
 import numpy as np
 from pathlib import Path
-from collections import Counter
+from label_utils import label_cache_get, label_cache_put, label_histogram, load_label_cache, read_labels, save_label_cache
 
-def check_label_schema(labels_dir: Path, sample_size: int = 5):
+# Per-directory cache of label histograms, keyed on file name + (mtime, size);
+# each script has its own cache file name and schema tag
+_LABEL_CACHE_NAME = ".dcss_label_histograms.json"
+_LABEL_CACHE_SCHEMA = "dcss_label_histogram/1"
+
+
+def _analyze(label_file: Path):
+    """
+    Histogram one label file. Runs inside a worker process.
+    Returns (file_name, labels, counts, error) for the non-background labels;
+    labels/counts are None if the file could not be read.
+    """
+    try:
+        img = nib.load(str(label_file))
+        labels, counts = label_histogram(read_labels(img))
+        
+        foreground = labels > 0  # Exclude background (0)
+        return label_file.name, labels[foreground], counts[foreground], None
+    except Exception as e:
+        return label_file.name, None, None, str(e)
+
+
+def _analyze_samples(sample_files: list, labels_dir: Path, use_cache: bool):
+    """
+    Yield _analyze results for each sample in sample order, serving unchanged
+    files from the label cache and histogramming the rest in a process pool.
+    """
+    cache = load_label_cache(labels_dir, _LABEL_CACHE_NAME, _LABEL_CACHE_SCHEMA) if use_cache else {}
+    hits = [label_cache_get(cache, label_file.name, label_file) for label_file in sample_files]
+    misses = [label_file for label_file, hit in zip(sample_files, hits) if hit is None]
+    
+    # Files are independent, so read + histogram them in parallel; map hands
+    # results back in submission order, interleaved here with the cache hits
+    with ProcessPoolExecutor(max_workers=max(1, min(8, len(misses)))) as executor:
+        results = executor.map(_analyze, misses)
+        for label_file, hit in zip(sample_files, hits):
+            if hit is not None:
+                yield label_file.name, np.asarray(hit[0]), np.asarray(hit[1], dtype=np.int64), None
+                continue
+            name, labels, counts, err = next(results)
+            if use_cache and err is None:
+                label_cache_put(cache, name, label_file, [labels.tolist(), counts.tolist()])
+            yield name, labels, counts, err
+    
+    if use_cache:
+        save_label_cache(labels_dir, _LABEL_CACHE_NAME, _LABEL_CACHE_SCHEMA, cache)
+
+
+def check_label_schema(labels_dir: Path, sample_size: int = 5, use_cache: bool = True):
     """
     Check the labeling schema of segmentation files.
     Verifies if labels follow the expected convention (1=C1, 2=C2, ..., 7=C7).
@@ -11,6 +61,8 @@ def check_label_schema(labels_dir: Path, sample_size: int = 5):
     Args:
         labels_dir: Directory containing label/segmentation files
         sample_size: Number of files to sample for checking
+        use_cache: Reuse per-file histograms from labels_dir/.dcss_label_histograms.json
+                   for files whose mtime and size are unchanged
     """
     labels_dir = Path(labels_dir)
     
@@ -39,33 +91,29 @@ def check_label_schema(labels_dir: Path, sample_size: int = 5):
         sample_files = [label_files[i * step] for i in range(sample_size)]
     
     # Analyze each sample
-    all_labels = []
-    label_counts = Counter()
+    # present[label] = number of sampled files containing that label
+    present = np.zeros(256, dtype=np.int32)
     
-    for label_file in sample_files:
-        print(f"Analyzing: {label_file.name}")
+    for name, unique_labels, counts, err in _analyze_samples(sample_files, labels_dir, use_cache):
+        print(f"Analyzing: {name}")
         
-        try:
-            img = nib.load(str(label_file))
-            data = np.asarray(img.dataobj)
-            
-            unique_labels = np.unique(data)
-            unique_labels = unique_labels[unique_labels > 0]  # Exclude background (0)
-            
-            print(f"  Unique labels found: {sorted(unique_labels.tolist())}")
-            
-            # Count voxels per label
-            for label in unique_labels:
-                count = np.sum(data == label)
-                print(f"    Label {int(label)}: {count:,} voxels")
-                label_counts[int(label)] += 1
-            
-            all_labels.extend(unique_labels.tolist())
-            print()
-            
-        except Exception as e:
-            print(f"  ERROR: Could not read file: {e}")
+        if err is not None:
+            print(f"  ERROR: Could not read file: {err}")
             print()
+            continue
+        
+        label_idx = unique_labels.astype(np.int64)
+        if label_idx.size and label_idx[-1] >= present.size:  # Labels above 255: grow the accumulator
+            present = np.pad(present, (0, int(label_idx[-1]) + 1 - present.size))
+        present[label_idx] += 1
+        
+        print(f"  Unique labels found: {unique_labels.tolist()}")
+        
+        # Count voxels per label
+        for label, count in zip(unique_labels.tolist(), counts.tolist()):
+            print(f"    Label {label}: {count:,} voxels")
+        
+        print()
     
     # Summary analysis
     print("="*80)
@@ -73,15 +121,16 @@ def check_label_schema(labels_dir: Path, sample_size: int = 5):
     print("="*80)
     print()
     
-    # Get all unique labels across all samples
-    unique_all = sorted(set(int(x) for x in all_labels))
+    # Get all unique labels across all samples (excluding background)
+    present[0] = 0
+    unique_all = np.nonzero(present)[0].tolist()
     print(f"All unique labels across samples: {unique_all}")
     print()
     
     # Count how many files contain each label
     print("Label frequency across sampled files:")
-    for label in sorted(label_counts.keys()):
-        frequency = label_counts[label]
+    for label in unique_all:
+        frequency = int(present[label])
         percentage = (frequency / len(sample_files)) * 100
         print(f"  Label {label}: appears in {frequency}/{len(sample_files)} files ({percentage:.1f}%)")
     print()
@@ -151,4 +200,4 @@ if __name__ == "__main__":
     labels_dir = Path(r"C:\\Users\\anoma\\Downloads\\spine-segmentation-data-cleaning\\DukeCSS\\labels")
     
     # Check more files if you want a more thorough analysis
-    check_label_schema(labels_dir, sample_size=10)
\ No newline at end of file
+    check_label_schema(labels_dir, sample_size=10, use_cache="--no-cache" not in sys.argv[1:])
\ No newline at end of file
@@ -1,38 +1,69 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
 from pathlib import Path
-import shutil
+import sys
 import nibabel as nib
-import numpy as np
+from label_utils import (label_cache_get, label_cache_put, link_or_copy, load_label_cache, present_labels, quick_reject,
+                         read_labels, save_label_cache, scan_labels_by_slab)
+
+# Per-directory cache of label check results, keyed on file name + (mtime, size);
+# each script has its own cache file name and schema tag
+_LABEL_CACHE_NAME = ".rsna_label_checks.json"
+_LABEL_CACHE_SCHEMA = "rsna_label_check/1"
 
 
 def check_cervical_to_t3_labels(seg_path: Path) -> dict:
     """
     Check if segmentation contains ONLY labels 1-10 (C1-C7, T1-T3) and background (0).
     
+    Cases are rejected on a max reduction alone, without collecting their
+    labels, so 'labels_found' is empty for out-of-range cases. Uncompressed
+    .nii files are first checked at both ends of the stack, then streamed
+    slab by slab until the first out-of-range slab; .nii.gz files are read
+    whole (gzip has no cheap random access).
+    
     Returns {'is_valid': bool, 'labels_found': list, 'reason': str}
     """
     try:
-        img = nib.load(seg_path)
-        data = img.get_fdata()
-        unique_labels = np.unique(data)
-        unique_labels = unique_labels[unique_labels > 0]  # Exclude background (0)
+        img = nib.load(seg_path, mmap=False)
+        
+        if str(seg_path).endswith('.nii') and len(img.shape) == 3:
+            max_seen = quick_reject(img, 10)
+            if max_seen is None:
+                labels_found, max_seen = scan_labels_by_slab(img, 10)
+            else:
+                labels_found = None
+        else:
+            data = read_labels(img)
+            max_seen = data.max() if data.size else 0
+            labels_found = None if max_seen > 10 else present_labels(data)
+        
+        # Fast reject: a single max reduction, no unique/sort needed
+        if labels_found is None:
+            return {
+                'is_valid': False,
+                'labels_found': [],
+                'reason': f'Contains labels outside C1-T3 range (max label {max_seen})'
+            }
+        
+        labels_found = labels_found.tolist()  # Background (0) is already excluded
         
-        if len(unique_labels) == 0:
+        if len(labels_found) == 0:
             return {'is_valid': False, 'labels_found': [], 'reason': 'No labels found'}
         
         # Check if ALL labels are in range 1-10 (C1-C7 = 1-7, T1-T3 = 8-10)
-        all_valid = all(1 <= label <= 10 for label in unique_labels)
+        invalid_labels = [label for label in labels_found if label < 1 or label > 10]
         
-        if not all_valid:
-            invalid_labels = [label for label in unique_labels if label < 1 or label > 10]
+        if invalid_labels:
             return {
                 'is_valid': False,
-                'labels_found': list(unique_labels),
+                'labels_found': labels_found,
                 'reason': f'Contains labels outside C1-T3 range: {invalid_labels}'
             }
         
         return {
             'is_valid': True,
-            'labels_found': list(unique_labels),
+            'labels_found': labels_found,
             'reason': 'Valid C1-T3 scan'
         }
         
@@ -40,9 +71,44 @@ def check_cervical_to_t3_labels(seg_path: Path) -> dict:
         return {'is_valid': False, 'labels_found': [], 'reason': f'Error reading file: {e}'}
 
 
-def filter_rsna_dataset(input_dir: Path, output_dir: Path):
+def _process_case(seg_file: Path, volumes_dir: Path, out_volumes_dir: Path, out_segmentations_dir: Path,
+                  cached_check: dict = None):
+    """
+    Check one case's labels and copy it to the output if valid.
+    Runs inside a worker process. A cached_check skips reading the segmentation.
+    
+    Returns (case_id, label_check); label_check is None if the volume is missing.
+    """
+    case_id = seg_file.stem  # e.g., "case_0000"
+    vol_file = volumes_dir / f"{case_id}.nii"
+    
+    # Check if corresponding volume exists
+    if not vol_file.exists():
+        return case_id, None
+    
+    # Check segmentation labels
+    label_check = cached_check or check_cervical_to_t3_labels(seg_file)
+    
+    if label_check['is_valid']:
+        # Copy both files with nnUNet naming
+        # Volume: {case_id}_0000.nii.gz
+        # Segmentation: {case_id}.nii.gz
+        # Hardlink when output is on the same filesystem as the input
+        link_or_copy(vol_file, out_volumes_dir / f"{case_id}_0000.nii.gz")
+        link_or_copy(seg_file, out_segmentations_dir / f"{case_id}.nii.gz")
+    
+    return case_id, label_check
+
+
+def filter_rsna_dataset(input_dir: Path, output_dir: Path, max_workers: int = None, use_cache: bool = True):
     """
     Filter RSNA dataset to only include cases with C1-T3 labels (1-10).
+    Cases are checked and copied in a process pool (max_workers defaults
+    to os.cpu_count()); results are printed in case order afterwards.
+    Valid cases are hardlinked when output_dir is on the same filesystem
+    as input_dir, and copied otherwise.
+    With use_cache, label checks are stored in segmentations/.rsna_label_checks.json
+    and reused on later runs for files whose mtime and size are unchanged.
     """
     volumes_dir = input_dir / "volumes"
     segmentations_dir = input_dir / "segmentations"
@@ -65,25 +131,32 @@ def filter_rsna_dataset(input_dir: Path, output_dir: Path):
     valid_count = 0
     filtered_count = 0
     
-    for seg_file in seg_files:
-        case_id = seg_file.stem  # e.g., "case_0000"
-        vol_file = volumes_dir / f"{case_id}.nii"
-        
-        # Check if corresponding volume exists
-        if not vol_file.exists():
+    # Reuse label checks for segmentations unchanged since the last run
+    cache = load_label_cache(segmentations_dir, _LABEL_CACHE_NAME, _LABEL_CACHE_SCHEMA) if use_cache else {}
+    cached_checks = [label_cache_get(cache, f.name, f) for f in seg_files]
+    if use_cache:
+        print(f"Label cache hits: {sum(c is not None for c in cached_checks)}/{len(seg_files)}\n")
+    
+    # Each case is independent; collect results first, print single-threaded
+    n = len(seg_files)
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        results = list(executor.map(_process_case, seg_files, [volumes_dir] * n,
+                                    [out_volumes_dir] * n, [out_segmentations_dir] * n,
+                                    cached_checks))
+    
+    if use_cache:
+        for seg_file, cached_check, (_, label_check) in zip(seg_files, cached_checks, results):
+            if cached_check is None and label_check is not None:
+                read_error = label_check['reason'].startswith('Error reading file')
+                label_cache_put(cache, seg_file.name, seg_file, None if read_error else label_check)
+        save_label_cache(segmentations_dir, _LABEL_CACHE_NAME, _LABEL_CACHE_SCHEMA, cache)
+    
+    for case_id, label_check in results:
+        if label_check is None:
             print(f"  WARNING: Volume not found for {case_id}")
             continue
         
-        # Check segmentation labels
-        label_check = check_cervical_to_t3_labels(seg_file)
-        
         if label_check['is_valid']:
-            # Copy both files with nnUNet naming
-            # Volume: {case_id}_0000.nii.gz
-            # Segmentation: {case_id}.nii.gz
-            shutil.copy2(vol_file, out_volumes_dir / f"{case_id}_0000.nii.gz")
-            shutil.copy2(seg_file, out_segmentations_dir / f"{case_id}.nii.gz")
-            
             valid_count += 1
             print(f"  ✓ {case_id} - Labels: {label_check['labels_found']}")
         else:
@@ -108,6 +181,7 @@ def filter_rsna_dataset(input_dir: Path, output_dir: Path):
 def main():
     input_dir = Path("C:\\Users\\anoma\\Downloads\\surgipath-datasets\\RSNA")
     output_dir = Path("RSNA_out")
+    use_cache = "--no-cache" not in sys.argv[1:]
     
     # Validate input structure
     if not (input_dir / "volumes").exists():
@@ -119,7 +193,7 @@ def main():
         return
     
     # Filter dataset
-    num_valid = filter_rsna_dataset(input_dir, output_dir)
+    num_valid = filter_rsna_dataset(input_dir, output_dir, use_cache=use_cache)
     
     if num_valid == 0:
         print("\nWARNING: No valid cases found!")
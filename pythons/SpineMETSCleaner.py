@@ -1,11 +1,42 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+import io
+import os
 from pathlib import Path
-from typing import Optional
+import sys
+from typing import Iterator, Optional
+import cv2
 import numpy as np
 import SimpleITK as sitk
 import json
 import pandas as pd
 import pydicom
-from rt_utils import RTStructBuilder
+
+# Study Description filters for cervical-relevant studies (plain lowercase substrings)
+CERVICAL_KEYWORDS = ['clavicle', 'neck', 'cranio']
+EXCLUDE_KEYWORDS = ['lumbar', 'pelvis', 'abdomen', 'rib', 'chest', 'thoracic', 'brain', 'head']
+
+# Header fields copied into the CT metadata JSON
+_CT_META_TAGS = ['StudyInstanceUID', 'SeriesInstanceUID', 'SeriesDescription', 'FrameOfReferenceUID']
+
+# Nearest-neighbour label resampler, built once per process and reused for
+# every study that process handles.
+# Output pixel type is left unset so it follows the input image.
+# Each worker process builds its own _RESAMPLER at import; it keeps per-call
+# state, so it must not be shared across threads.
+_RESAMPLER = sitk.ResampleImageFilter()
+_RESAMPLER.SetInterpolator(sitk.sitkNearestNeighbor)
+_RESAMPLER.SetDefaultPixelValue(0)
+
+
+def _contains_any(values: np.ndarray, keywords: list[str]) -> np.ndarray:
+    """
+    Boolean mask of which strings in values contain any of the keywords.
+    """
+    mask = np.zeros(len(values), dtype=bool)
+    for kw in keywords:
+        mask |= np.char.find(values, kw) >= 0
+    return mask
 
 
 def retrieve_dataset(dataset_dir: str, metadata_path: str) -> Optional[list[Path]]:
@@ -13,24 +44,24 @@ def retrieve_dataset(dataset_dir: str, metadata_path: str) -> Optional[list[Path
     Retrieves STUDY paths from metadata.csv, filtering for cervical-relevant studies.
     Returns list of study directory paths.
     """
+    required_cols = ['Study Description', 'File Location']
+    
     try:
-        metadata_df = pd.read_csv(metadata_path)
+        # Only parse the two columns we use
+        metadata_df = pd.read_csv(metadata_path, usecols=lambda c: c in required_cols)
     except Exception as e:
         print(f"Error reading metadata.csv: {e}")
         return None
     
-    required_cols = ['Study Description', 'File Location']
     for c in required_cols:
         if c not in metadata_df.columns:
             print(f"metadata.csv missing required column: {c}")
             return None
     
-    # Filter for cervical-relevant studies
-    cervical_keywords = ['clavicle', 'neck', 'cranio']
-    exclude_keywords = ['lumbar', 'pelvis', 'abdomen', 'rib', 'chest', 'thoracic', 'brain', 'head']
-    sd = metadata_df['Study Description'].fillna('').str.lower()
-    relevant_mask = sd.str.contains('|'.join(cervical_keywords), na=False) & \
-                    ~sd.str.contains('|'.join(exclude_keywords), na=False)
+    # Filter for cervical-relevant studies: lowercase once, then one
+    # vectorized substring search per keyword (no regex engine)
+    sd = metadata_df['Study Description'].fillna('').astype(str).str.lower().to_numpy(dtype=str)
+    relevant_mask = _contains_any(sd, CERVICAL_KEYWORDS) & ~_contains_any(sd, EXCLUDE_KEYWORDS)
     
     relevant_df = metadata_df[relevant_mask]
     print(f"Found {len(relevant_df)} cervical-relevant series across multiple studies.")
@@ -40,18 +71,26 @@ def retrieve_dataset(dataset_dir: str, metadata_path: str) -> Optional[list[Path
         return None
     
     # Get unique STUDY paths
-    data_root = Path(dataset_dir)
+    data_root = Path(os.path.normpath(dataset_dir))
     study_paths = set()
     
-    for _, row in relevant_df.iterrows():
-        loc = Path(str(row['File Location']))
-        if loc.is_absolute():
-            study_path = loc.parent
-        else:
-            full_series_path = (data_root / loc).resolve()
-            study_path = full_series_path.parent if full_series_path.exists() else None
+    # Group the series folders by study, then list each study folder once
+    # (one level, no recursive walk of the dataset) instead of an is_dir()
+    # per metadata row
+    series_by_study = {}
+    for loc in relevant_df['File Location'].astype(str).unique():
+        loc = Path(loc)
+        series_path = loc if loc.is_absolute() else Path(os.path.normpath(data_root / loc))
+        series_by_study.setdefault(series_path.parent, set()).add(series_path.name)
+    
+    for study_path, series_names in series_by_study.items():
+        try:
+            with os.scandir(study_path) as entries:
+                series_dirs = {e.name for e in entries if e.is_dir()}
+        except OSError:
+            continue  # Study folder missing or unreadable
         
-        if study_path and study_path.is_dir():
+        if series_names & series_dirs:
             study_paths.add(study_path)
     
     study_paths = sorted(study_paths)
@@ -76,36 +115,59 @@ def retrieve_dataset(dataset_dir: str, metadata_path: str) -> Optional[list[Path
         return None
 
 
+def _iter_dcm(root) -> Iterator[os.DirEntry]:
+    """
+    Yield every .dcm file under root in a single os.scandir walk.
+    """
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _iter_dcm(entry.path)
+            elif entry.name.lower().endswith(".dcm") and entry.is_file():
+                yield entry
+
+
 def dicom_directory(study_dir: Path) -> dict[str, dict]:
     """
     Returns { series_uid: {'modality': str, 'series_dir': Path, 'files': [paths...]} }
     Scans entire study folder and categorizes all series by modality.
+    
+    DICOM series are laid out one per folder, so only one header per folder
+    is read (just SeriesInstanceUID and Modality) and every sibling file is
+    assigned to that series.
     """
+    # Group files by their parent folder
+    files_by_dir = {}
+    for entry in _iter_dcm(study_dir):
+        files_by_dir.setdefault(os.path.dirname(entry.path), []).append(entry.path)
+    
     index = {}
     
-    for path in study_dir.rglob("*.dcm"):
-        if not path.is_file():
-            continue
-        
-        try:
-            ds = pydicom.dcmread(path, stop_before_pixels=True)
+    for series_dir, files in files_by_dir.items():
+        # Classify the folder from the first readable header
+        series_uid = modality = None
+        for path in files:
+            try:
+                ds = pydicom.dcmread(path, stop_before_pixels=True,
+                                     specific_tags=['SeriesInstanceUID', 'Modality'])
+            except Exception:
+                continue
             series_uid = getattr(ds, "SeriesInstanceUID", None)
             modality = getattr(ds, "Modality", None)
-            
-            if not (series_uid and modality):
-                continue
-            
-            if series_uid not in index:
-                index[series_uid] = {
-                    'modality': modality,
-                    'series_dir': path.parent,
-                    'files': []
-                }
-            
-            index[series_uid]['files'].append(str(path))
-            
-        except Exception:
+            if series_uid and modality:
+                break
+        
+        if not (series_uid and modality):
             continue
+        
+        if series_uid not in index:
+            index[series_uid] = {
+                'modality': modality,
+                'series_dir': Path(series_dir),
+                'files': []
+            }
+        
+        index[series_uid]['files'].extend(files)
     
     return index
 
@@ -130,20 +192,17 @@ def convert_ct_to_nifti(series_dir: Path) -> tuple[sitk.Image, dict]:
         raise ValueError(f"No DICOM files found for series {series_id}")
     
     reader.SetFileNames(dicom_names)
-    reader.MetaDataDictionaryArrayUpdateOn()
-    reader.LoadPrivateTagsOn()
     
     try:
         img = reader.Execute()
     except Exception as e:
         raise ValueError(f"Failed to read CT series: {e}")
     
-    # Extract metadata
+    # Extract metadata from the first slice's header only - SimpleITK doesn't
+    # need to build per-slice metadata dictionaries for this
+    ds0 = pydicom.dcmread(dicom_names[0], stop_before_pixels=True, specific_tags=_CT_META_TAGS)
     meta = {
-        "StudyInstanceUID": reader.GetMetaData(0, "0020|000d").strip() if "0020|000d" in reader.GetMetaDataKeys(0) else "NA",
-        "SeriesInstanceUID": reader.GetMetaData(0, "0020|000e").strip() if "0020|000e" in reader.GetMetaDataKeys(0) else "NA",
-        "SeriesDescription": reader.GetMetaData(0, "0008|103e").strip() if "0008|103e" in reader.GetMetaDataKeys(0) else "NA",
-        "FrameOfReferenceUID": reader.GetMetaData(0, "0020|0052").strip() if "0020|0052" in reader.GetMetaDataKeys(0) else "NA",
+        **{tag: str(ds0.get(tag, "NA")).strip() for tag in _CT_META_TAGS},
         "Modality": "CT",
         "NumSlices": img.GetSize()[2],
         "Spacing": list(img.GetSpacing()),
@@ -154,6 +213,17 @@ def convert_ct_to_nifti(series_dir: Path) -> tuple[sitk.Image, dict]:
     return img, meta
 
 
+def _same_geometry(img: sitk.Image, reference: sitk.Image) -> bool:
+    """
+    True if img already sits on reference's voxel grid (size, spacing,
+    origin and direction), i.e. resampling would be a no-op.
+    """
+    return (img.GetSize() == reference.GetSize()
+            and np.allclose(img.GetSpacing(), reference.GetSpacing())
+            and np.allclose(img.GetOrigin(), reference.GetOrigin())
+            and np.allclose(img.GetDirection(), reference.GetDirection()))
+
+
 def convert_seg_to_nifti(seg_files: list[str], reference_ct: sitk.Image) -> Optional[sitk.Image]:
     """
     Reads DICOM SEG file and resamples to match CT geometry.
@@ -168,24 +238,77 @@ def convert_seg_to_nifti(seg_files: list[str], reference_ct: sitk.Image) -> Opti
         # Read SEG as single file
         seg_img = sitk.ReadImage(seg_path)
         
-        # Resample to match CT geometry
-        resampler = sitk.ResampleImageFilter()
-        resampler.SetReferenceImage(reference_ct)
-        resampler.SetInterpolator(sitk.sitkNearestNeighbor)
-        resampler.SetDefaultPixelValue(0)
-        
-        seg_resampled = resampler.Execute(seg_img)
+        # Already on the CT grid - skip the full-volume resample
+        if _same_geometry(seg_img, reference_ct):
+            return seg_img
         
-        return seg_resampled
+        # Resample to match CT geometry
+        return resample_to_reference(seg_img, reference_ct)
         
     except Exception as e:
         print(f"  Failed to read SEG: {e}")
         return None
 
 
-def convert_rtstruct_to_nifti(rtstruct_files: list[str], series_dir: Path, reference_ct: sitk.Image) -> Optional[sitk.Image]:
+def _rasterize_contours(rtstruct_ds, reference_ct: sitk.Image) -> np.ndarray:
+    """
+    Fills all RTSTRUCT contours into a single uint8 mask laid out like reference_ct.
+    Contour points are gathered into flat arrays (points, per-contour offsets, ROI id,
+    slice index) so the physical -> voxel transform runs once for the whole structure set,
+    then polygons are filled per slice with one cv2.fillPoly call per ROI.
     """
-    Reads RTSTRUCT and rasterizes contours to match CT geometry using rt-utils.
+    size_x, size_y, size_z = reference_ct.GetSize()
+    mask_np = np.zeros((size_z, size_y, size_x), dtype=np.uint8)
+    
+    chunks, roi_ids = [], []
+    for roi_idx, roi_contour in enumerate(getattr(rtstruct_ds, 'ROIContourSequence', [])):
+        for contour in getattr(roi_contour, 'ContourSequence', []):
+            points = np.asarray(contour.ContourData, dtype=np.float64).reshape(-1, 3)
+            if len(points) >= 3:  # Need at least a triangle to fill
+                chunks.append(points)
+                roi_ids.append(roi_idx)
+    
+    if not chunks:
+        return mask_np
+    
+    lengths = np.fromiter((len(c) for c in chunks), dtype=np.int64, count=len(chunks))
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    points = np.concatenate(chunks)
+    roi_ids = np.asarray(roi_ids)
+    
+    # Physical (LPS) -> continuous voxel index for every point in one matrix product
+    origin = np.asarray(reference_ct.GetOrigin())
+    direction = np.asarray(reference_ct.GetDirection()).reshape(3, 3)
+    index_to_physical = direction * np.asarray(reference_ct.GetSpacing())
+    index = (points - origin) @ np.linalg.inv(index_to_physical).T
+    
+    # Each contour is planar: its slice is the mean z index of its points
+    z_index = np.rint(np.add.reduceat(index[:, 2], offsets[:-1]) / lengths).astype(np.int64)
+    xy = np.rint(index[:, :2]).astype(np.int32)
+    
+    # Visit contours grouped by (slice, ROI); skip anything outside the CT volume
+    order = np.lexsort((roi_ids, z_index))
+    start = 0
+    while start < len(order):
+        z, roi = z_index[order[start]], roi_ids[order[start]]
+        stop = start
+        while stop < len(order) and z_index[order[stop]] == z and roi_ids[order[stop]] == roi:
+            stop += 1
+        
+        if 0 <= z < size_z:
+            polys = [xy[offsets[i]:offsets[i + 1]] for i in order[start:stop]]
+            # Contours of the same ROI share one fill so inner contours cut holes
+            cv2.fillPoly(mask_np[z], polys, 1)
+        start = stop
+    
+    return mask_np
+
+
+def convert_rtstruct_to_nifti(rtstruct_files: list[str], reference_ct: sitk.Image) -> Optional[sitk.Image]:
+    """
+    Reads RTSTRUCT and rasterizes its contours onto the already-loaded CT grid.
+    Contours are mapped through reference_ct's geometry, so the CT slices
+    don't have to be read and sorted a second time.
     """
     if len(rtstruct_files) != 1:
         print(f"  Warning: RTSTRUCT should be single file, found {len(rtstruct_files)}. Using first.")
@@ -193,14 +316,11 @@ def convert_rtstruct_to_nifti(rtstruct_files: list[str], series_dir: Path, refer
     rtstruct_path = rtstruct_files[0]
     
     try:
-        # Load RTSTRUCT with rt-utils
-        rtstruct = RTStructBuilder.create_from(
-            dicom_series_path=str(series_dir),
-            rt_struct_path=rtstruct_path
-        )
+        # Load only the RTSTRUCT itself
+        rtstruct_ds = pydicom.dcmread(rtstruct_path)
         
         # Get all ROI names
-        roi_names = rtstruct.get_roi_names()
+        roi_names = [roi.ROIName for roi in getattr(rtstruct_ds, 'StructureSetROISequence', [])]
         
         if not roi_names:
             print("  No ROIs found in RTSTRUCT")
@@ -208,16 +328,11 @@ def convert_rtstruct_to_nifti(rtstruct_files: list[str], series_dir: Path, refer
         
         print(f"  Found ROIs: {roi_names}")
         
-        # Combine all ROIs into single mask
-        # Get mask for first ROI as template
-        mask_np = rtstruct.get_roi_mask_by_name(roi_names[0])
-        
-        # Add other ROIs
-        for roi_name in roi_names[1:]:
-            mask_np = np.logical_or(mask_np, rtstruct.get_roi_mask_by_name(roi_name))
+        # Rasterize every ROI straight into one uint8 mask (z, y, x) on the CT grid
+        mask_np = _rasterize_contours(rtstruct_ds, reference_ct)
         
         # Convert to SimpleITK image with CT geometry
-        mask_img = sitk.GetImageFromArray(mask_np.astype(np.uint8))
+        mask_img = sitk.GetImageFromArray(mask_np)
         mask_img.CopyInformation(reference_ct)
         
         return mask_img
@@ -232,13 +347,8 @@ def resample_to_reference(moving_img: sitk.Image, reference_img: sitk.Image) ->
     Resamples moving image to match reference image geometry.
     Uses nearest neighbor for label images.
     """
-    resampler = sitk.ResampleImageFilter()
-    resampler.SetReferenceImage(reference_img)
-    resampler.SetInterpolator(sitk.sitkNearestNeighbor)
-    resampler.SetDefaultPixelValue(0)
-    resampler.SetOutputPixelType(moving_img.GetPixelID())
-    
-    return resampler.Execute(moving_img)
+    _RESAMPLER.SetReferenceImage(reference_img)
+    return _RESAMPLER.Execute(moving_img)
 
 
 def create_nnunet_dataset_json(out_dir: Path, num_cases: int):
@@ -261,6 +371,122 @@ def create_nnunet_dataset_json(out_dir: Path, num_cases: int):
         json.dump(dataset_json, f, indent=2)
 
 
+def _convert_study(study_dir: Path, images_dir: Path, labels_dir: Path) -> bool:
+    """
+    Converts one study's CT and its SEG/RTSTRUCT mask into images_dir/labels_dir.
+    Returns True if both the CT and a segmentation were written.
+    """
+    print(f"\n{'='*60}")
+    print(f"Processing study: {study_dir.name}")
+    print(f"{'='*60}")
+    
+    # Extract patient ID from path structure
+    patient_id = study_dir.parent.name
+    
+    # Get all series in this study
+    series_index = dicom_directory(study_dir)
+    
+    if not series_index:
+        print(f"  No DICOM series found in {study_dir}")
+        return False
+    
+    # Separate CT and segmentation series
+    ct_series = {uid: data for uid, data in series_index.items() if data['modality'] == 'CT'}
+    seg_series = {uid: data for uid, data in series_index.items() if data['modality'] == 'SEG'}
+    rtstruct_series = {uid: data for uid, data in series_index.items() if data['modality'] == 'RTSTRUCT'}
+    
+    print(f"  Found {len(ct_series)} CT, {len(seg_series)} SEG, {len(rtstruct_series)} RTSTRUCT series")
+    
+    if not ct_series:
+        print("  No CT series found. Skipping study.")
+        return False
+    
+    if len(ct_series) > 1:
+        print(f"  WARNING: Found {len(ct_series)} CT series, expected 1. Using first.")
+    
+    # Get the single CT series
+    ct_uid, ct_data = next(iter(ct_series.items()))
+    print(f"  CT series: {len(ct_data['files'])} slices")
+    
+    try:
+        ct_img, ct_meta = convert_ct_to_nifti(ct_data['series_dir'])
+    except Exception as e:
+        print(f"  Failed to convert CT series: {e}")
+        return False
+    
+    if ct_meta["NumSlices"] < 10:
+        print(f"  Too few slices ({ct_meta['NumSlices']}). Skipping.")
+        return False
+    
+    # Save CT volume with patient ID
+    ct_filename = f"{patient_id}_0000.nii.gz"
+    sitk.WriteImage(ct_img, str(images_dir / ct_filename))
+    print(f"  Saved CT: {ct_filename}")
+    
+    # Find matching segmentation
+    mask_img = None
+    
+    # Try SEG first
+    if seg_series:
+        if len(seg_series) > 1:
+            print(f"  WARNING: Found {len(seg_series)} SEG series, expected 1. Using first.")
+        
+        _, seg_data = next(iter(seg_series.items()))
+        print(f"  Found SEG series with {len(seg_data['files'])} file(s)")
+        mask_img = convert_seg_to_nifti(seg_data['files'], ct_img)
+        
+        if mask_img is not None and not _same_geometry(mask_img, ct_img):
+            print(f"  Resampling SEG to match CT geometry")
+            mask_img = resample_to_reference(mask_img, ct_img)
+    
+    # If no SEG, try RTSTRUCT
+    if mask_img is None and rtstruct_series:
+        if len(rtstruct_series) > 1:
+            print(f"  WARNING: Found {len(rtstruct_series)} RTSTRUCT series, expected 1. Using first.")
+        
+        _, rt_data = next(iter(rtstruct_series.items()))
+        print(f"  Found RTSTRUCT series with {len(rt_data['files'])} file(s)")
+        mask_img = convert_rtstruct_to_nifti(
+            rt_data['files'],
+            ct_img
+        )
+    
+    # Save mask
+    if mask_img is not None:
+        seg_filename = f"{patient_id}.nii.gz"
+        sitk.WriteImage(mask_img, str(labels_dir / seg_filename))
+        print(f"  Saved segmentation: {seg_filename}")
+        print(f"  SUCCESS: Case {patient_id} complete")
+        return True
+    
+    print(f"  WARNING: No segmentation found for {patient_id}")
+    return False
+
+
+def _init_worker(itk_threads: int):
+    """
+    Split the cores between study workers instead of every worker's ITK
+    filters trying to use all of them.
+    """
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(itk_threads)
+
+
+def _process_study(study_dir: Path, images_dir: Path, labels_dir: Path):
+    """
+    Runs _convert_study inside a worker process.
+    Returns (success, log) where log is the study's buffered progress output,
+    so parallel studies don't interleave their prints.
+    """
+    log = io.StringIO()
+    with redirect_stdout(log):
+        try:
+            success = _convert_study(study_dir, images_dir, labels_dir)
+        except Exception as e:
+            print(f"  ERROR: Failed to process study: {e}")
+            success = False
+    return success, log.getvalue()
+
+
 def main():
     dataset_dir = "C:\\Users\\anoma\\Downloads\\surgipath-datasets\\SpineMETSCTSEG"
     metadata_path = "C:\\Users\\anoma\\Downloads\\surgipath-datasets\\SpineMETSCTSEG\\metadata.csv"
@@ -280,92 +506,15 @@ def main():
     
     processed_count = 0
     
-    for study_dir in study_paths:
-        print(f"\n{'='*60}")
-        print(f"Processing study: {study_dir.name}")
-        print(f"{'='*60}")
-        
-        # Extract patient ID from path structure
-        patient_id = study_dir.parent.name
-        
-        # Get all series in this study
-        series_index = dicom_directory(study_dir)
-        
-        if not series_index:
-            print(f"  No DICOM series found in {study_dir}")
-            continue
-        
-        # Separate CT and segmentation series
-        ct_series = {uid: data for uid, data in series_index.items() if data['modality'] == 'CT'}
-        seg_series = {uid: data for uid, data in series_index.items() if data['modality'] == 'SEG'}
-        rtstruct_series = {uid: data for uid, data in series_index.items() if data['modality'] == 'RTSTRUCT'}
-        
-        print(f"  Found {len(ct_series)} CT, {len(seg_series)} SEG, {len(rtstruct_series)} RTSTRUCT series")
-        
-        if not ct_series:
-            print("  No CT series found. Skipping study.")
-            continue
-        
-        if len(ct_series) > 1:
-            print(f"  WARNING: Found {len(ct_series)} CT series, expected 1. Using first.")
-        
-        # Get the single CT series
-        ct_uid, ct_data = next(iter(ct_series.items()))
-        print(f"  CT series: {len(ct_data['files'])} slices")
-        
-        try:
-            ct_img, ct_meta = convert_ct_to_nifti(ct_data['series_dir'])
-        except Exception as e:
-            print(f"  Failed to convert CT series: {e}")
-            continue
-        
-        if ct_meta["NumSlices"] < 10:
-            print(f"  Too few slices ({ct_meta['NumSlices']}). Skipping.")
-            continue
-        
-        # Save CT volume with patient ID
-        ct_filename = f"{patient_id}_0000.nii.gz"
-        sitk.WriteImage(ct_img, str(images_dir / ct_filename))
-        print(f"  Saved CT: {ct_filename}")
-        
-        # Find matching segmentation
-        mask_img = None
-        
-        # Try SEG first
-        if seg_series:
-            if len(seg_series) > 1:
-                print(f"  WARNING: Found {len(seg_series)} SEG series, expected 1. Using first.")
-            
-            _, seg_data = next(iter(seg_series.items()))
-            print(f"  Found SEG series with {len(seg_data['files'])} file(s)")
-            mask_img = convert_seg_to_nifti(seg_data['files'], ct_img)
-            
-            if mask_img is not None and mask_img.GetSize() != ct_img.GetSize():
-                print(f"  Resampling SEG to match CT geometry")
-                mask_img = resample_to_reference(mask_img, ct_img)
-        
-        # If no SEG, try RTSTRUCT
-        if mask_img is None and rtstruct_series:
-            if len(rtstruct_series) > 1:
-                print(f"  WARNING: Found {len(rtstruct_series)} RTSTRUCT series, expected 1. Using first.")
-            
-            _, rt_data = next(iter(rtstruct_series.items()))
-            print(f"  Found RTSTRUCT series with {len(rt_data['files'])} file(s)")
-            mask_img = convert_rtstruct_to_nifti(
-                rt_data['files'],
-                ct_data['series_dir'],
-                ct_img
-            )
-        
-        # Save mask
-        if mask_img is not None:
-            seg_filename = f"{patient_id}.nii.gz"
-            sitk.WriteImage(mask_img, str(labels_dir / seg_filename))
-            print(f"  Saved segmentation: {seg_filename}")
-            processed_count += 1
-            print(f"  SUCCESS: Case {patient_id} complete")
-        else:
-            print(f"  WARNING: No segmentation found for {patient_id}")
+    # Studies are independent (own output files), so convert them in parallel;
+    # logs come back in study order and are written one study at a time
+    workers = max(1, os.cpu_count() // 2)
+    itk_threads = max(1, os.cpu_count() // workers)
+    n = len(study_paths)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(itk_threads,)) as executor:
+        for success, log in executor.map(_process_study, study_paths, [images_dir] * n, [labels_dir] * n, chunksize=1):
+            sys.stdout.write(log)
+            processed_count += success
     
     # Create dataset.json
     if processed_count > 0:
@@ -1,13 +1,24 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
 from pathlib import Path
-import shutil
 import json
-import re
+import sys
 import nibabel as nib
 import numpy as np
 from typing import Optional
+from label_utils import (extract_verse_subject_info, label_cache_get, label_cache_put, load_label_cache,
+                         present_labels, quick_reject, read_labels, save_label_cache, scan_labels_by_slab,
+                         write_cases_gz)
 
+# Persistent analyze_segmentation results, keyed on "path|max_label" -> [st_mtime_ns, st_size, analysis].
+# Kept under ~/.cache rather than next to the inputs; bump the schema tag when
+# the analysis dict changes so stale entries are dropped
+_CACHE_DIR = Path.home() / ".cache" / "spine_cleaner"
+_CACHE_NAME = "analysis.json"
+_CACHE_SCHEMA = "uni_cleaner_analysis/1"
 
-def check_vertebrae_ratio(labels: list[int]) -> dict:
+
+def check_vertebrae_ratio(labels: np.ndarray) -> dict:
     """
     Check if at least 2/3 (66.7%) of vertebrae are cervical.
     
@@ -24,11 +35,9 @@ def check_vertebrae_ratio(labels: list[int]) -> dict:
     
     Returns {'is_valid': bool, 'cervical_count': int, 'thoracic_count': int, 'cervical_percentage': float, 'reason': str}
     """
-    cervical = [l for l in labels if 1 <= l <= 7]
-    thoracic = [l for l in labels if 8 <= l <= 19]
-    
-    cervical_count = len(cervical)
-    thoracic_count = len(thoracic)
+    # labels holds each present label once, so counting is a masked sum
+    cervical_count = int(((labels >= 1) & (labels <= 7)).sum())
+    thoracic_count = int(((labels >= 8) & (labels <= 19)).sum())
     total_count = cervical_count + thoracic_count
     
     if total_count == 0:
@@ -74,9 +83,30 @@ def analyze_segmentation(seg_path: Path, max_label: int = 19) -> dict:
     """
     try:
         img = nib.load(seg_path) # type: ignore
-        data = img.get_fdata() # type: ignore
-        unique_labels = np.unique(data)
-        unique_labels = unique_labels[unique_labels > 0]  # Exclude background
+        
+        if str(seg_path).endswith('.nii') and len(img.shape) == 3:
+            # Uncompressed: check both ends of the stack first, then read
+            # z-slabs, never the whole volume at once
+            max_seen = quick_reject(img, max_label)
+            if max_seen is None:
+                unique_labels, max_seen = scan_labels_by_slab(img, max_label)
+            else:
+                unique_labels = None
+        else:
+            data = read_labels(img)
+            max_seen = data.max() if data.size else 0
+            unique_labels = present_labels(data) if max_seen <= max_label else None  # Excludes background (0)
+        
+        # Fast reject: a max reduction, no label enumeration needed
+        if unique_labels is None:
+            return {
+                'is_valid': False,
+                'labels_found': [],
+                'cervical_count': 0,
+                'thoracic_count': 0,
+                'ratio': 0.0,
+                'reason': f'Contains labels beyond T12 (max label {max_seen})'
+            }
         
         if len(unique_labels) == 0:
             return {
@@ -89,11 +119,11 @@ def analyze_segmentation(seg_path: Path, max_label: int = 19) -> dict:
             }
         
         # Check for invalid labels (beyond max_label)
-        invalid_labels = [l for l in unique_labels if l > max_label]
+        invalid_labels = unique_labels[unique_labels > max_label].tolist()
         if invalid_labels:
             return {
                 'is_valid': False,
-                'labels_found': list(unique_labels),
+                'labels_found': unique_labels.tolist(),
                 'cervical_count': 0,
                 'thoracic_count': 0,
                 'ratio': 0.0,
@@ -101,11 +131,11 @@ def analyze_segmentation(seg_path: Path, max_label: int = 19) -> dict:
             }
         
         # Check vertebrae ratio
-        ratio_check = check_vertebrae_ratio(list(unique_labels))
+        ratio_check = check_vertebrae_ratio(unique_labels)
         
         return {
             'is_valid': ratio_check['is_valid'],
-            'labels_found': list(unique_labels),
+            'labels_found': unique_labels.tolist(),
             'cervical_count': ratio_check['cervical_count'],
             'thoracic_count': ratio_check['thoracic_count'],
             'cervical_percentage': ratio_check['cervical_percentage'],
@@ -125,40 +155,86 @@ def analyze_segmentation(seg_path: Path, max_label: int = 19) -> dict:
 
 # ==================== VerSe Dataset Handler ====================
 
-def extract_verse_subject_info(filename: str) -> dict:
-    """Extract subject ID and split ID from VerSe naming conventions."""
-    match = re.search(r'sub-(gl\d+|verse\d+)', filename)
-    if match:
-        subject_id = match.group(1)
-        split_match = re.search(r'split-verse(\d+)', filename)
-        split_id = split_match.group(1) if split_match else None
-        return {'subject_id': subject_id, 'split_id': split_id}
-    
-    legacy_match = re.search(r'(GL|verse)(\d+)', filename, re.IGNORECASE)
-    if legacy_match:
-        prefix = legacy_match.group(1).lower()
-        number = legacy_match.group(2)
-        subject_id = f"{prefix}{number}"
-        return {'subject_id': subject_id, 'split_id': None}
-    
-    return {'subject_id': None, 'split_id': None}
-
-
 def find_verse_nii_files(directory: Path) -> list[tuple[Path, dict]]:
     """Find all .nii files in VerSe directory structure."""
     files_info = []
-    for subject_dir in directory.iterdir():
-        if not subject_dir.is_dir():
-            continue
-        for file in subject_dir.iterdir():
-            if file.suffix == '.nii':
-                info = extract_verse_subject_info(file.name)
-                if info['subject_id']:
-                    files_info.append((file, info))
+    with os.scandir(directory) as subject_dirs:
+        for subject_dir in subject_dirs:
+            if not subject_dir.is_dir():
+                continue
+            with os.scandir(subject_dir.path) as files:
+                for file in files:
+                    if file.name.endswith('.nii'):
+                        info = extract_verse_subject_info(file.name)
+                        if info['subject_id']:
+                            files_info.append((Path(file.path), info))
     return files_info
 
 
-def process_verse_dataset(volumes_dir: Path, segmentations_dir: Path):
+def _analyze_cases(jobs: list[tuple[str, Path, Path]], no_match: int, dataset: str, max_workers: int = None,
+                   max_label: int = 19, use_cache: bool = True) -> tuple[list[dict], dict[str, int]]:
+    """
+    Analyze (case_id, volume, segmentation) jobs in a process pool
+    (max_workers defaults to os.cpu_count()), then print and tally the
+    results in job order from the parent so output doesn't interleave.
+    With use_cache, segmentations unchanged since an earlier run (same
+    mtime and size, same max_label) are answered from _CACHE_DIR/_CACHE_NAME.
+    Returns (matched_pairs, stats); pairs are tagged with dataset and
+    no_match (cases without a partner file) is passed through to stats.
+    """
+    cache = load_label_cache(_CACHE_DIR, _CACHE_NAME, _CACHE_SCHEMA) if use_cache else {}
+    keys = [f"{seg_path.absolute()}|{max_label}" for _, _, seg_path in jobs]
+    analyses = [label_cache_get(cache, key, seg_path) for key, (_, _, seg_path) in zip(keys, jobs)]
+    
+    misses = [i for i, analysis in enumerate(analyses) if analysis is None]
+    if use_cache:
+        print(f"  Analysis cache hits: {len(jobs) - len(misses)}/{len(jobs)}")
+    
+    if misses:
+        with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+            results = executor.map(analyze_segmentation, [jobs[i][2] for i in misses],
+                                   [max_label] * len(misses), chunksize=4)
+            for i, analysis in zip(misses, results):
+                analyses[i] = analysis
+                read_error = analysis['reason'].startswith('Error reading file')
+                label_cache_put(cache, keys[i], jobs[i][2], None if read_error else analysis)
+        
+        if use_cache:
+            save_label_cache(_CACHE_DIR, _CACHE_NAME, _CACHE_SCHEMA, cache)
+    
+    # Results are all in hand, so build the per-case log and write it once
+    # instead of a console print per case
+    matched_pairs = []
+    log_lines = []
+    filtered_ratio = filtered_labels = 0
+    for (case_id, vol_path, seg_path), analysis in zip(jobs, analyses):
+        if analysis['is_valid']:
+            matched_pairs.append({
+                'volume': vol_path,
+                'segmentation': seg_path,
+                'case_id': case_id,
+                'dataset': dataset,
+                'labels': analysis['labels_found'],
+                'cervical_count': analysis['cervical_count'],
+                'thoracic_count': analysis['thoracic_count']
+            })
+            log_lines.append(f"    ✓ {case_id}: {analysis['cervical_percentage']:.1f}% cervical ({analysis['cervical_count']}C/{analysis['cervical_count']+analysis['thoracic_count']}T total)\n")
+        else:
+            if 'ratio' in analysis['reason'].lower():
+                filtered_ratio += 1
+            else:
+                filtered_labels += 1
+            log_lines.append(f"    ✗ {case_id}: {analysis['reason']}\n")
+    
+    sys.stdout.write("".join(log_lines))
+    sys.stdout.flush()
+    
+    stats = {'valid': len(matched_pairs), 'filtered_ratio': filtered_ratio,
+             'filtered_labels': filtered_labels, 'no_match': no_match}
+    return matched_pairs, stats
+
+
+def process_verse_dataset(volumes_dir: Path, segmentations_dir: Path, max_workers: int = None, use_cache: bool = True):
     """Process VerSe dataset and return valid matched pairs."""
     volume_files = find_verse_nii_files(volumes_dir)
     seg_files = find_verse_nii_files(segmentations_dir)
@@ -166,89 +242,45 @@ def process_verse_dataset(volumes_dir: Path, segmentations_dir: Path):
     print(f"  Found {len(volume_files)} volume files")
     print(f"  Found {len(seg_files)} segmentation files")
     
-    # Create lookup for segmentations
-    seg_lookup = {}
-    for seg_path, seg_info in seg_files:
-        key = (seg_info['subject_id'], seg_info['split_id'])
-        seg_lookup[key] = seg_path
+    # Create lookup for segmentations, keyed on (subject_id, split_id)
+    seg_lookup = {(seg_info['subject_id'], seg_info['split_id']): seg_path for seg_path, seg_info in seg_files}
     
-    matched_pairs = []
-    stats = {'valid': 0, 'filtered_ratio': 0, 'filtered_labels': 0, 'no_match': 0}
+    jobs = []
     
     for vol_path, vol_info in volume_files:
         key = (vol_info['subject_id'], vol_info['split_id'])
         
         if key in seg_lookup:
-            seg_path = seg_lookup[key]
             case_id = f"{vol_info['subject_id']}_split{vol_info['split_id']}" if vol_info['split_id'] else vol_info['subject_id']
-            
-            # Analyze segmentation
-            analysis = analyze_segmentation(seg_path, max_label=19)
-            
-            if analysis['is_valid']:
-                matched_pairs.append({
-                    'volume': vol_path,
-                    'segmentation': seg_path,
-                    'case_id': case_id,
-                    'labels': analysis['labels_found'],
-                    'cervical_count': analysis['cervical_count'],
-                    'thoracic_count': analysis['thoracic_count']
-                })
-                stats['valid'] += 1
-                print(f"    ✓ {case_id}: {analysis['cervical_percentage']:.1f}% cervical ({analysis['cervical_count']}C/{analysis['cervical_count']+analysis['thoracic_count']}T total)")
-            else:
-                if 'ratio' in analysis['reason'].lower():
-                    stats['filtered_ratio'] += 1
-                else:
-                    stats['filtered_labels'] += 1
-                print(f"    ✗ {case_id}: {analysis['reason']}")
-        else:
-            stats['no_match'] += 1
+            jobs.append((case_id, vol_path, seg_lookup[key]))
     
-    return matched_pairs, stats
+    # Analyze segmentations; unmatched volumes count as no_match
+    return _analyze_cases(jobs, len(volume_files) - len(jobs), 'verse', max_workers, use_cache=use_cache)
 
 
 # ==================== RSNA Dataset Handler ====================
 
-def process_rsna_dataset(volumes_dir: Path, segmentations_dir: Path) -> tuple[list[dict], dict[str, int]]:
+def process_rsna_dataset(volumes_dir: Path, segmentations_dir: Path, max_workers: int = None,
+                         use_cache: bool = True) -> tuple[list[dict], dict[str, int]]:
     """Process RSNA dataset and return valid matched pairs."""
     seg_files = sorted(segmentations_dir.glob("case_*.nii"))
     
     print(f"  Found {len(seg_files)} segmentation files")
     
-    matched_pairs = []
-    stats = {'valid': 0, 'filtered_ratio': 0, 'filtered_labels': 0, 'no_match': 0}
+    jobs = []
+    
+    # One directory read instead of an exists() stat per case
+    with os.scandir(volumes_dir) as entries:
+        vol_names = {e.name for e in entries if e.name.endswith('.nii')}
     
     for seg_file in seg_files:
         case_id = seg_file.stem  # e.g., "case_0000"
-        vol_file = volumes_dir / f"{case_id}.nii"
-        
-        if not vol_file.exists():
-            stats['no_match'] += 1
-            continue
         
-        # Analyze segmentation
-        analysis = analyze_segmentation(seg_file, max_label=19)
-        
-        if analysis['is_valid']:
-            matched_pairs.append({
-                'volume': vol_file,
-                'segmentation': seg_file,
-                'case_id': case_id,
-                'labels': analysis['labels_found'],
-                'cervical_count': analysis['cervical_count'],
-                'thoracic_count': analysis['thoracic_count']
-            })
-            stats['valid'] += 1
-            print(f"    ✓ {case_id}: {analysis['cervical_percentage']:.1f}% cervical ({analysis['cervical_count']}C/{analysis['cervical_count']+analysis['thoracic_count']}T total)")
-        else:
-            if 'ratio' in analysis['reason'].lower():
-                stats['filtered_ratio'] += 1
-            else:
-                stats['filtered_labels'] += 1
-            print(f"    ✗ {case_id}: {analysis['reason']}")
+        if f"{case_id}.nii" in vol_names:
+            jobs.append((case_id, volumes_dir / f"{case_id}.nii", seg_file))
     
-    return matched_pairs, stats
+    # Analyze segmentations; segmentations without a volume count as no_match
+    return _analyze_cases(jobs, len(seg_files) - len(jobs), 'rsna', max_workers, use_cache=use_cache)
 
 
 # ==================== Main Processing ====================
@@ -260,18 +292,11 @@ def organize_to_nnunet(matched_pairs: list[dict], output_dir: Path, dataset_name
     images_dir.mkdir(parents=True, exist_ok=True)
     labels_dir.mkdir(parents=True, exist_ok=True)
     
-    for i, pair in enumerate(matched_pairs):
-        # Use original case_id with dataset prefix
-        case_id = f"{dataset_name}_{pair['case_id']}"
-        
-        # Copy volume
-        volume_out = images_dir / f"{case_id}_0000.nii.gz"
-        shutil.copy2(pair['volume'], volume_out)
-        
-        # Copy segmentation
-        seg_out = labels_dir / f"{case_id}.nii.gz"
-        shutil.copy2(pair['segmentation'], seg_out)
-        
+    # Use original case_id with dataset prefix
+    case_ids = [f"{dataset_name}_{pair['case_id']}" for pair in matched_pairs]
+    
+    # Cases are written on a thread pool; progress is counted in case order
+    for i, _ in enumerate(write_cases_gz(matched_pairs, case_ids, images_dir, labels_dir)):
         if (i + 1) % 10 == 0:
             print(f"  Processed {i + 1}/{len(matched_pairs)} files...")
 
@@ -311,6 +336,9 @@ def main():
     process_verse = True
     process_rsna = True
     
+    # Reuse segmentation analyses from earlier runs (see _CACHE_DIR)
+    use_cache = True
+    
     # ==================== PROCESSING ====================
     all_pairs = []
     combined_stats = {
@@ -328,7 +356,7 @@ def main():
         verse_segs = verse_dir / "segmentations"
         
         if verse_vols.exists() and verse_segs.exists():
-            verse_pairs, verse_stats = process_verse_dataset(verse_vols, verse_segs)
+            verse_pairs, verse_stats = process_verse_dataset(verse_vols, verse_segs, use_cache=use_cache)
             all_pairs.extend(verse_pairs)
             combined_stats['verse'] = verse_stats
             print(f"\n  VerSe Summary: {verse_stats['valid']} valid cases")
@@ -345,7 +373,7 @@ def main():
         rsna_segs = rsna_dir / "segmentations"
         
         if rsna_vols.exists() and rsna_segs.exists():
-            rsna_pairs, rsna_stats = process_rsna_dataset(rsna_vols, rsna_segs)
+            rsna_pairs, rsna_stats = process_rsna_dataset(rsna_vols, rsna_segs, use_cache=use_cache)
             all_pairs.extend(rsna_pairs)
             combined_stats['rsna'] = rsna_stats
             print(f"\n  RSNA Summary: {rsna_stats['valid']} valid cases")
@@ -361,16 +389,17 @@ def main():
     print("Organizing to nnUNet format...")
     print(f"{'='*70}")
     
-    # Organize files
-    verse_count = len([p for p in all_pairs if 'verse' in str(p['volume']) or 'gl' in p['case_id'].lower()])
-    rsna_count = len(all_pairs) - verse_count
+    # Organize files - split by the dataset tag set when each pair was matched
+    verse_pairs_only, rsna_pairs_only = [], []
+    for p in all_pairs:
+        (verse_pairs_only if p['dataset'] == 'verse' else rsna_pairs_only).append(p)
+    verse_count = len(verse_pairs_only)
+    rsna_count = len(rsna_pairs_only)
     
     if verse_count > 0:
-        verse_pairs_only = [p for p in all_pairs if 'verse' in str(p['volume']) or 'gl' in p['case_id'].lower()]
         organize_to_nnunet(verse_pairs_only, output_dir, "verse")
     
     if rsna_count > 0:
-        rsna_pairs_only = [p for p in all_pairs if 'verse' not in str(p['volume']) and 'gl' not in p['case_id'].lower()]
         organize_to_nnunet(rsna_pairs_only, output_dir, "rsna")
     
     # Create dataset.json
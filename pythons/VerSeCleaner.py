@@ -1,36 +1,10 @@
+import os
 from pathlib import Path
-import shutil
 import json
-import re
+import sys
 import nibabel as nib
-import numpy as np
-
-
-def extract_subject_info(filename: str) -> dict:
-    """
-    Extract subject ID and split ID from various VerSe naming conventions.
-    Returns {'subject_id': str, 'split_id': str or None}
-    """
-    # Standard format: sub-{id}_split-{split}_ct.nii or sub-{id}_ct.nii
-    match = re.search(r'sub-(gl\d+|verse\d+)', filename)
-    if match:
-        subject_id = match.group(1)
-        
-        # Check for split
-        split_match = re.search(r'split-verse(\d+)', filename)
-        split_id = split_match.group(1) if split_match else None
-        
-        return {'subject_id': subject_id, 'split_id': split_id}
-    
-    # Legacy format: GL{number}_CT or verse{number}_CT
-    legacy_match = re.search(r'(GL|verse)(\d+)', filename, re.IGNORECASE)
-    if legacy_match:
-        prefix = legacy_match.group(1).lower()
-        number = legacy_match.group(2)
-        subject_id = f"{prefix}{number}"
-        return {'subject_id': subject_id, 'split_id': None}
-    
-    return {'subject_id': None, 'split_id': None}
+from label_utils import (extract_verse_subject_info, present_labels, quick_reject, read_labels,
+                         scan_labels_by_slab, write_cases_gz)
 
 
 def check_relevant_labels(seg_path: Path) -> dict:
@@ -46,27 +20,45 @@ def check_relevant_labels(seg_path: Path) -> dict:
     """
     try:
         img = nib.load(seg_path) # type: ignore
-        data = img.get_fdata() # type: ignore
-        unique_labels = np.unique(data)
-        unique_labels = unique_labels[unique_labels > 0]  # Exclude background (0)
+        
+        if str(seg_path).endswith('.nii') and len(img.shape) == 3:
+            # Uncompressed: check both ends of the stack first, then read
+            # z-slabs, stopping at the first one with a label > 10
+            max_seen = quick_reject(img, max_label=10)
+            if max_seen is None:
+                unique_labels, max_seen = scan_labels_by_slab(img, max_label=10)
+            else:
+                unique_labels = None
+        else:
+            data = read_labels(img)
+            max_seen = data.max() if data.size else 0
+            unique_labels = present_labels(data) if max_seen <= 10 else None  # Excludes background (0)
+        
+        # Fast reject: a max reduction, no label enumeration needed
+        if unique_labels is None:
+            return {
+                'is_valid': False,
+                'labels_found': [],
+                'reason': f'Contains non-relevant labels (max label {max_seen})'
+            }
         
         if len(unique_labels) == 0:
             return {'is_valid': False, 'labels_found': [], 'reason': 'No labels found'}
 
         # Check if ALL labels are relevant (1-10) (Cervial + Thoratic up to T3 to get more data validated because very little files have only C1-C7)
-        all_relevant = all(1 <= label <= 10 for label in unique_labels)
+        all_relevant = bool(((unique_labels >= 1) & (unique_labels <= 10)).all())
         
         if not all_relevant:
-            non_relevant = [label for label in unique_labels if label < 1 or label > 7]
+            non_relevant = unique_labels[(unique_labels < 1) | (unique_labels > 7)].tolist()
             return {
                 'is_valid': False,
-                'labels_found': list(unique_labels),
+                'labels_found': unique_labels.tolist(),
                 'reason': f'Contains non-relevant labels: {non_relevant}'
             }
         
         return {
             'is_valid': True,
-            'labels_found': list(unique_labels),
+            'labels_found': unique_labels.tolist(),
             'reason': 'Valid relevant-only scan'
         }
         
@@ -80,15 +72,19 @@ def find_nii_files(directory: Path) -> list[tuple[Path, dict]]:
     """
     files_info = []
     
-    for subject_dir in directory.iterdir():
-        if not subject_dir.is_dir():
-            continue
-        
-        for file in subject_dir.iterdir():
-            if file.suffix == '.nii':
-                info = extract_subject_info(file.name)
-                if info['subject_id']:
-                    files_info.append((file, info))
+    # scandir entries carry name/type from the directory read, so no
+    # per-entry Path objects or stat calls; Path is built only for matches
+    with os.scandir(directory) as subject_dirs:
+        for subject_dir in subject_dirs:
+            if not subject_dir.is_dir():
+                continue
+            
+            with os.scandir(subject_dir.path) as files:
+                for file in files:
+                    if file.name.endswith('.nii'):
+                        info = extract_verse_subject_info(file.name)
+                        if info['subject_id']:
+                            files_info.append((Path(file.path), info))
     
     return files_info
 
@@ -106,13 +102,8 @@ def match_volumes_to_segmentations(volumes_dir: Path, segmentations_dir: Path) -
     print(f"Found {len(volume_files)} volume files")
     print(f"Found {len(seg_files)} segmentation files")
     
-    # Create lookup dict for segmentations
-    seg_lookup = {}
-    for seg_path, seg_info in seg_files:
-        subject_id = seg_info['subject_id']
-        split_id = seg_info['split_id']
-        key = (subject_id, split_id)
-        seg_lookup[key] = seg_path
+    # Create lookup dict for segmentations, keyed on (subject_id, split_id)
+    seg_lookup = {(seg_info['subject_id'], seg_info['split_id']): seg_path for seg_path, seg_info in seg_files}
     
     # Match volumes to segmentations and filter by relevant-only criteria
     matched_pairs = []
@@ -126,8 +117,9 @@ def match_volumes_to_segmentations(volumes_dir: Path, segmentations_dir: Path) -
         if key in seg_lookup:
             seg_path = seg_lookup[key]
             
-            # Check if segmentation has ONLY relevant labels
-            print(f"\n  Checking: {subject_id}" + (f"_split{split_id}" if split_id else ""))
+            # Check if segmentation has ONLY relevant labels. The case's log
+            # lines go out in one write once it's checked
+            log_lines = [f"\n  Checking: {subject_id}" + (f"_split{split_id}" if split_id else "") + "\n"]
             label_check = check_relevant_labels(seg_path)
             
             if label_check['is_valid']:
@@ -142,15 +134,17 @@ def match_volumes_to_segmentations(volumes_dir: Path, segmentations_dir: Path) -
                     'segmentation': seg_path,
                     'case_id': case_id
                 })
-                print(f"    ✓ VALID - Labels: {label_check['labels_found']}")
+                log_lines.append(f"    ✓ VALID - Labels: {label_check['labels_found']}\n")
             else:
                 filtered_count += 1
-                print(f"    ✗ FILTERED - {label_check['reason']}")
+                log_lines.append(f"    ✗ FILTERED - {label_check['reason']}\n")
                 if label_check['labels_found']:
-                    print(f"      Labels found: {label_check['labels_found']}")
+                    log_lines.append(f"      Labels found: {label_check['labels_found']}\n")
+            sys.stdout.write("".join(log_lines))
         else:
-            print(f"  WARNING: No segmentation found for volume {vol_path.name}")
+            sys.stdout.write(f"  WARNING: No segmentation found for volume {vol_path.name}\n")
     
+    sys.stdout.flush()
     print(f"\n{'='*60}")
     print(f"Matched pairs: {len(matched_pairs)}")
     print(f"Filtered out (contains non-relevant labels): {filtered_count}")
@@ -172,17 +166,10 @@ def organize_to_nnunet(matched_pairs: list[dict], output_dir: Path):
     print(f"Organizing {len(matched_pairs)} cases to nnUNet format")
     print(f"{'='*60}")
     
-    for pair in matched_pairs:
-        case_id = pair['case_id']
-        
-        # Copy volume
-        volume_out = images_dir / f"{case_id}_0000.nii.gz"
-        shutil.copy2(pair['volume'], volume_out)
+    # Cases are written on a thread pool; progress is still printed in case order
+    case_ids = [pair['case_id'] for pair in matched_pairs]
+    for case_id in write_cases_gz(matched_pairs, case_ids, images_dir, labels_dir):
         print(f"  Copied volume: {case_id}_0000.nii.gz")
-        
-        # Copy segmentation
-        seg_out = labels_dir / f"{case_id}.nii.gz"
-        shutil.copy2(pair['segmentation'], seg_out)
         print(f"  Copied segmentation: {case_id}.nii.gz")
     
     return len(matched_pairs)
@@ -1,24 +1,79 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import compress
+import os
+import sys
 import nibabel as nib
 import numpy as np
 from pathlib import Path
-import shutil
+from typing import Optional
+from label_utils import (find_centroid_json, label_cache_get, label_cache_put, labels_from_centroid_file,
+                         labels_from_centroids, link_or_copy, load_label_cache, save_label_cache)
 
-def count_cervical_vertebrae(seg_file: Path) -> int:
+_NII_SUFFIXES = ('.nii', '.nii.gz')
+
+# Cervical counts from earlier runs, stored in the segmentations directory
+# and keyed on subject/file name. Each entry records the source of the count
+# ("mask" or "json") and is stamped with that source file's (mtime, size).
+# The file name and schema tag are specific to this script:
+# accept_all_cervical.py caches label sets for the same directory in its own file
+_LABEL_CACHE_NAME = ".verse_v3_cervical_counts.json"
+_LABEL_CACHE_SCHEMA = "verse_v3_cervical_count/2"
+
+def _cervical_labels_in(data: np.ndarray) -> set:
+    """
+    Return the set of cervical labels (1-7) present in data.
+    """
+    cervical = data[(data >= 1) & (data <= 7)].astype(np.intp, copy=False)
+    return set(np.flatnonzero(np.bincount(cervical, minlength=8)).tolist())
+
+
+def count_cervical_vertebrae(seg_file: Path, slab_depth: int = 16, use_centroids: bool = True, on_error=0) -> int:
     """
     Count how many cervical vertebrae (labels 1-7) are present in segmentation.
-    Returns the count of unique cervical labels found.
+    Returns the count of unique cervical labels found, or on_error if the
+    file can't be read. With use_centroids the sibling centroid JSON is used
+    when present instead of scanning voxels.
     """
+    if use_centroids:
+        labels = labels_from_centroids(seg_file)
+        if labels is not None:
+            return len(labels & set(range(1, 8)))
+    
     try:
-        img = nib.load(str(seg_file))
-        data = np.asarray(img.dataobj)
-        unique_labels = np.unique(data)
+        # keep_file_open holds one file handle across the slab reads below.
+        # For .nii.gz that means the gzip stream is inflated once, front to
+        # back, instead of being reopened and re-inflated from the start
+        # for every slab
+        img = nib.load(str(seg_file), keep_file_open=True)
+        proxy = img.dataobj
+        
+        if len(proxy.shape) != 3:
+            return len(_cervical_labels_in(np.asarray(proxy)))
         
-        # Count cervical vertebrae (labels 1-7)
-        cervical_labels = [label for label in unique_labels if 1 <= label <= 7]
-        return len(cervical_labels)
+        # NIfTI data is stored Fortran-order, so each z-slab is one
+        # contiguous byte range and the slabs are read in file order. Stop
+        # as soon as all 7 cervical labels have been seen
+        found = set()
+        for z in range(0, proxy.shape[2], slab_depth):
+            found |= _cervical_labels_in(np.asarray(proxy[:, :, z:z + slab_depth]))
+            if len(found) == 7:
+                break
+        return len(found)
     except Exception as e:
         print(f"  ERROR reading {seg_file.name}: {e}")
-        return 0
+        return on_error
+
+
+def _count_with_source(seg_file: Path, ctd_file: Optional[Path]) -> tuple[Optional[int], str]:
+    """
+    Count cervical vertebrae from ctd_file when given and usable, else from
+    the mask. Returns (count, "json" or "mask"); count is None on read errors.
+    """
+    if ctd_file is not None:
+        labels = labels_from_centroid_file(ctd_file)
+        if labels is not None:
+            return len(labels & set(range(1, 8))), "json"
+    return count_cervical_vertebrae(seg_file, use_centroids=False, on_error=None), "mask"
 
 
 def copy_or_gzip_file(input_path: Path, output_path: Path) -> bool:
@@ -26,22 +81,48 @@ def copy_or_gzip_file(input_path: Path, output_path: Path) -> bool:
     Copy file to output. If already .gz, just copy. If .nii, copy as-is with .gz extension.
     This is MUCH faster than actually gzipping.
     Note: Output will always be .nii.gz but may not be compressed if input wasn't compressed.
+    Files are hardlinked when output is on the same filesystem as input.
     """
     try:
-        if input_path.suffix == '.gz':
-            # Already gzipped, just copy
-            shutil.copy2(input_path, output_path)
-        else:
-            # Just copy the .nii file and name it .nii.gz
-            # This is MUCH faster than actually compressing
-            # nnUNet will handle compression during preprocessing anyway
-            shutil.copy2(input_path, output_path)
+        # No compression either way; nnUNet will handle compression during
+        # preprocessing anyway
+        link_or_copy(input_path, output_path)
         return True
     except Exception as e:
         print(f"  ERROR copying {input_path.name}: {e}")
         return False
 
 
+def _index_subjects(root: Path, masks: bool) -> dict[str, list[tuple[str, Path]]]:
+    """
+    Map each sub-* directory under root to its .nii / .nii.gz files as
+    (name without extension, path), in one walk. masks=True keeps only mask
+    files (name contains 'msk' or 'seg'), masks=False drops them.
+    """
+    index = {}
+    with os.scandir(root) as subjects:
+        for sub in subjects:
+            if not (sub.name.startswith('sub-') and sub.is_dir()):
+                continue
+            with os.scandir(sub.path) as entries:
+                # Names come straight from the DirEntry; only kept files get a Path
+                index[sub.name] = [(e.name[:-7] if e.name.endswith('.gz') else e.name[:-4], Path(e.path))
+                                   for e in entries
+                                   if e.name.endswith(_NII_SUFFIXES)
+                                   and (('msk' in e.name or 'seg' in e.name) == masks) and e.is_file()]
+    return index
+
+
+def _copy_pair(pair: dict, out_vol_path: Path, out_seg_path: Path) -> tuple[bool, bool]:
+    """
+    Copy one accepted pair (fast copy, no compression).
+    Returns (volume_ok, segmentation_ok); the segmentation is skipped if the volume fails.
+    """
+    if not copy_or_gzip_file(pair['volume'], out_vol_path):
+        return False, False
+    return True, copy_or_gzip_file(pair['segmentation'], out_seg_path)
+
+
 def find_verse_pairs(base_path: Path) -> list[dict]:
     """
     Find all volume/segmentation pairs in VerSe dataset structure.
@@ -59,28 +140,21 @@ def find_verse_pairs(base_path: Path) -> list[dict]:
     
     pairs = []
     
-    # Get all subject subdirectories in segmentations
-    seg_subjects = [d for d in segs_dir.iterdir() if d.is_dir() and d.name.startswith('sub-')]
+    # Index both trees up front (DirEntry caches the type, so is_dir/is_file
+    # don't need a stat per entry); pairing below is then dict lookups only
+    seg_index = _index_subjects(segs_dir, masks=True)
+    vol_index = _index_subjects(volumes_dir, masks=False)
     
-    for seg_subject_dir in sorted(seg_subjects):
-        subject_id = seg_subject_dir.name  # e.g., "sub-gl003"
-        
+    for subject_id in sorted(seg_index):  # e.g., "sub-gl003"
         # Find corresponding volume directory
-        vol_subject_dir = volumes_dir / subject_id
-        
-        if not vol_subject_dir.exists():
+        if subject_id not in vol_index:
             print(f"  WARNING: No volume directory found for {subject_id}")
             continue
         
-        # Find segmentation files in this subject's directory
-        seg_files = list(seg_subject_dir.glob("*.nii")) + list(seg_subject_dir.glob("*.nii.gz"))
-        # Filter for mask files (usually contain 'msk' or 'seg')
-        seg_files = [f for f in seg_files if 'msk' in f.name or 'seg' in f.name]
-        
-        # Find volume files
-        vol_files = list(vol_subject_dir.glob("*.nii")) + list(vol_subject_dir.glob("*.nii.gz"))
-        # Filter out segmentation files if they're in volumes directory
-        vol_files = [f for f in vol_files if 'msk' not in f.name and 'seg' not in f.name]
+        # Segmentation files are mask files (usually contain 'msk' or 'seg');
+        # volume files exclude any masks sitting in the volumes directory
+        seg_files = seg_index[subject_id]
+        vol_files = vol_index[subject_id]
         
         if not seg_files:
             print(f"  WARNING: No segmentation files found in {subject_id}")
@@ -92,23 +166,21 @@ def find_verse_pairs(base_path: Path) -> list[dict]:
         
         # Match segmentation with volume
         # Typically there's one volume and one segmentation per subject
-        for seg_file in seg_files:
+        for seg_base, seg_file in seg_files:
             # Try to find matching volume
             # Remove segmentation-specific parts from filename
-            seg_base = seg_file.stem.replace('.nii', '')
             seg_base_clean = seg_base.replace('_seg-vert_msk', '').replace('_seg', '').replace('_msk', '')
             
             # Look for volume with similar name
             vol_file = None
-            for vf in vol_files:
-                vol_base = vf.stem.replace('.nii', '')
+            for vol_base, vf in vol_files:
                 if seg_base_clean in vol_base or vol_base in seg_base_clean:
                     vol_file = vf
                     break
             
             # If no match found, just take the first volume file (usually only one per subject)
             if vol_file is None and len(vol_files) == 1:
-                vol_file = vol_files[0]
+                vol_file = vol_files[0][1]
             
             if vol_file:
                 pairs.append({
@@ -122,13 +194,18 @@ def find_verse_pairs(base_path: Path) -> list[dict]:
     return pairs
 
 
-def process_verse_dataset(base_path: Path, min_cervical_count: int = 3):
+def process_verse_dataset(base_path: Path, min_cervical_count: int = 3, use_cache: bool = True,
+                          use_centroids: bool = True):
     """
     Process VerSe dataset:
     1. Find all volume/segmentation pairs
     2. Filter for cases with 3+ cervical vertebrae
     3. Gzip files if needed (NO!)
     4. Rename to VerSe_xxx_0000.nii.gz and VerSe_xxx.nii.gz format
+    With use_centroids, counts come from the sibling centroid JSONs where
+    present instead of scanning the masks.
+    With use_cache, cervical counts are stored in segmentations/.verse_v3_cervical_counts.json
+    and reused while the file they came from (mask or JSON) keeps its mtime and size.
     """
     base_path = Path(base_path)
     
@@ -163,33 +240,66 @@ def process_verse_dataset(base_path: Path, min_cervical_count: int = 3):
     print("Step 2: Filtering and processing files...")
     print()
     
-    accepted_pairs = []
-    rejected_pairs = []
+    # Reuse counts from earlier runs for unchanged files
+    segs_dir = base_path / "segmentations"
+    cache = load_label_cache(segs_dir, _LABEL_CACHE_NAME, _LABEL_CACHE_SCHEMA) if use_cache else {}
+    keys = [f"{pair['subject']}/{pair['segmentation'].name}" for pair in pairs]
+    ctd_files = [find_centroid_json(pair['segmentation']) if use_centroids else None for pair in pairs]
+    cervical_counts = []
+    for pair, key, ctd_file in zip(pairs, keys, ctd_files):
+        source = "mask" if ctd_file is None else "json"
+        hit = label_cache_get(cache, key, pair['segmentation'] if ctd_file is None else ctd_file)
+        cervical_counts.append(hit[0] if hit and hit[1] == source else None)
+    
+    misses = [i for i, count in enumerate(cervical_counts) if count is None]
+    if use_cache:
+        print(f"  Label cache hits: {len(pairs) - len(misses)}/{len(pairs)}")
+        print()
+    
+    # Count the rest up front; reads and decompression release the GIL, so
+    # the scans overlap. Results are reported below in pair order
+    if misses:
+        with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+            results = executor.map(_count_with_source, [pairs[i]['segmentation'] for i in misses],
+                                   [ctd_files[i] for i in misses])
+            for i, (count, source) in zip(misses, results):
+                if count is None:
+                    cervical_counts[i] = 0  # Read errors aren't cached so they're retried next run
+                else:
+                    cervical_counts[i] = count
+                    # Stamp with the file the count actually came from
+                    label_cache_put(cache, keys[i], ctd_files[i] if source == "json" else pairs[i]['segmentation'],
+                                    [count, source])
+        
+        if use_cache:
+            save_label_cache(segs_dir, _LABEL_CACHE_NAME, _LABEL_CACHE_SCHEMA, cache)
     
-    for pair in pairs:
+    # Partition in one C-level pass; rejected pairs are only ever counted
+    accepted = [count >= min_cervical_count for count in cervical_counts]
+    accepted_pairs = list(compress(pairs, accepted))
+    num_rejected = len(pairs) - len(accepted_pairs)
+    
+    # Every count is in hand, so build the report and write it once
+    log_lines = []
+    for pair, cervical_count, is_accepted in zip(pairs, cervical_counts, accepted):
         seg_file = pair['segmentation']
         subject = pair['subject']
         
-        # Count cervical vertebrae
-        cervical_count = count_cervical_vertebrae(seg_file)
-        
-        print(f"Checking {subject}:")
-        print(f"  Segmentation: {seg_file.name}")
-        print(f"  Cervical vertebrae found: {cervical_count}")
+        log_lines.append(f"Checking {subject}:\n")
+        log_lines.append(f"  Segmentation: {seg_file.name}\n")
+        log_lines.append(f"  Cervical vertebrae found: {cervical_count}\n")
         
-        if cervical_count >= min_cervical_count:
-            print(f"  ✓ ACCEPTED (has {cervical_count} >= {min_cervical_count})")
-            accepted_pairs.append(pair)
+        if is_accepted:
+            log_lines.append(f"  ✓ ACCEPTED (has {cervical_count} >= {min_cervical_count})\n\n")
         else:
-            print(f"  ✗ REJECTED (has {cervical_count} < {min_cervical_count})")
-            rejected_pairs.append(pair)
-        print()
+            log_lines.append(f"  ✗ REJECTED (has {cervical_count} < {min_cervical_count})\n\n")
+    sys.stdout.write("".join(log_lines))
     
     print()
     print("="*80)
     print(f"Filtering complete:")
     print(f"  Accepted: {len(accepted_pairs)} pairs")
-    print(f"  Rejected: {len(rejected_pairs)} pairs")
+    print(f"  Rejected: {num_rejected} pairs")
     print("="*80)
     print()
     
@@ -205,11 +315,16 @@ def process_verse_dataset(base_path: Path, min_cervical_count: int = 3):
     error_count = 0
     skipped_count = 0
     
+    # Skip pairs done by an earlier run up front, so the copy threads only
+    # get real work. One listing per output directory instead of two
+    # exists() stats per pair
+    with os.scandir(output_volumes) as entries:
+        done_volumes = {e.name for e in entries}
+    with os.scandir(output_labels) as entries:
+        done_labels = {e.name for e in entries}
+    
+    jobs = []
     for idx, pair in enumerate(accepted_pairs, start=1):
-        vol_file = pair['volume']
-        seg_file = pair['segmentation']
-        subject = pair['subject']
-        
         # Generate new names
         new_vol_name = f"VerSe_{idx:03d}_0000.nii"
         new_seg_name = f"VerSe_{idx:03d}.nii"
@@ -218,36 +333,38 @@ def process_verse_dataset(base_path: Path, min_cervical_count: int = 3):
         out_seg_path = output_labels / new_seg_name
         
         # Skip if already processed
-        if out_vol_path.exists() and out_seg_path.exists():
-            print(f"Skipping pair {idx:03d} ({subject}) - already processed")
+        if new_vol_name in done_volumes and new_seg_name in done_labels:
+            print(f"Skipping pair {idx:03d} ({pair['subject']}) - already processed")
             skipped_count += 1
             continue
         
-        print(f"Processing pair {idx:03d}/{len(accepted_pairs)} ({subject}):")
-        print(f"  Volume: {vol_file.name} → {new_vol_name}")
-        print(f"  Segmentation: {seg_file.name} → {new_seg_name}")
-        
-        try:
-            # Copy volume (fast copy, no compression)
-            if copy_or_gzip_file(vol_file, out_vol_path):
-                print(f"  ✓ Volume copied")
-            else:
-                raise Exception("Failed to process volume")
+        jobs.append((idx, pair, new_vol_name, new_seg_name, out_vol_path, out_seg_path))
+    
+    # Copies are I/O-bound, so overlap them; results are printed in pair order
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = executor.map(_copy_pair, [job[1] for job in jobs], [job[4] for job in jobs], [job[5] for job in jobs])
+        for (idx, pair, new_vol_name, new_seg_name, _, _), (vol_ok, seg_ok) in zip(jobs, results):
+            # One write per pair instead of a print per line
+            log_lines = [
+                f"Processing pair {idx:03d}/{len(accepted_pairs)} ({pair['subject']}):\n",
+                f"  Volume: {pair['volume'].name} → {new_vol_name}\n",
+                f"  Segmentation: {pair['segmentation'].name} → {new_seg_name}\n",
+            ]
             
-            # Copy segmentation (fast copy, no compression)
-            if copy_or_gzip_file(seg_file, out_seg_path):
-                print(f"  ✓ Segmentation copied")
+            if not vol_ok:
+                log_lines.append(f"  ✗ ERROR: Failed to process volume\n")
+                error_count += 1
             else:
-                raise Exception("Failed to process segmentation")
-            
-            success_count += 1
-            print(f"  Progress: {success_count}/{len(accepted_pairs)} complete")
-            print()
-            
-        except Exception as e:
-            print(f"  ✗ ERROR: {e}")
-            error_count += 1
-            print()
+                log_lines.append(f"  ✓ Volume copied\n")
+                if not seg_ok:
+                    log_lines.append(f"  ✗ ERROR: Failed to process segmentation\n")
+                    error_count += 1
+                else:
+                    log_lines.append(f"  ✓ Segmentation copied\n")
+                    success_count += 1
+                    log_lines.append(f"  Progress: {success_count}/{len(accepted_pairs)} complete\n")
+            log_lines.append("\n")
+            sys.stdout.write("".join(log_lines))
     
     # Final summary
     print("="*80)
@@ -268,4 +385,5 @@ if __name__ == "__main__":
     base_path = Path(r"C:\\Users\\anoma\\Downloads\\spine-segmentation-data-cleaning\\VerSe")
     
     # Process dataset (only accept cases with 3+ cervical vertebrae)
-    process_verse_dataset(base_path, min_cervical_count=3)
\ No newline at end of file
+    process_verse_dataset(base_path, min_cervical_count=3, use_cache="--no-cache" not in sys.argv[1:],
+                          use_centroids="--no-centroids" not in sys.argv[1:])
\ No newline at end of file
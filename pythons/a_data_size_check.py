@@ -1,7 +1,21 @@
+import fnmatch
+import os
 import matplotlib.pyplot as plt
 from pathlib import Path
 import numpy as np
 
+def _smallest_k(values: np.ndarray, k: int = 5) -> np.ndarray:
+    """
+    Indices of the k smallest values, ascending. Uses a partial selection
+    (argpartition) instead of sorting every value.
+    """
+    if len(values) > k:
+        idx = np.argpartition(values, k - 1)[:k]
+    else:
+        idx = np.arange(len(values))
+    return idx[np.argsort(values[idx], kind='stable')]
+
+
 def plot_file_size_distribution(folder_path: Path, file_pattern: str = "*", remove_outliers: bool = True):
     """
     Create visualizations of file size distribution in a folder.
@@ -17,8 +31,12 @@ def plot_file_size_distribution(folder_path: Path, file_pattern: str = "*", remo
         print(f"ERROR: Folder not found: {folder_path}")
         return
     
-    # Get all files matching pattern
-    files = list(folder_path.glob(file_pattern))
+    # Get all files matching pattern with their sizes in one directory pass
+    # (DirEntry.stat() is served from the scandir data on Windows and cached
+    # per entry elsewhere, instead of a separate stat per Path)
+    with os.scandir(folder_path) as entries:
+        files = [(e.name, e.stat().st_size) for e in entries
+                 if fnmatch.fnmatch(e.name, file_pattern) and e.is_file()]
     
     if not files:
         print(f"ERROR: No files found matching pattern '{file_pattern}' in {folder_path}")
@@ -28,17 +46,17 @@ def plot_file_size_distribution(folder_path: Path, file_pattern: str = "*", remo
     print(f"Pattern: {file_pattern}")
     print()
     
-    # Get file sizes in KB and MB
-    file_sizes_bytes = [f.stat().st_size for f in files]
-    file_sizes_kb = [size / 1024 for size in file_sizes_bytes]
-    file_sizes_mb = [size / (1024 * 1024) for size in file_sizes_bytes]
+    # Get file sizes in KB and MB as arrays (MB derived from KB, no
+    # per-element Python loops)
+    file_sizes_kb = np.fromiter((size for _, size in files), dtype=np.float64, count=len(files)) / 1024
+    file_sizes_mb = file_sizes_kb / 1024
     
     # Calculate statistics on ALL data
-    mean_kb = np.mean(file_sizes_kb)
+    mean_kb = file_sizes_kb.mean()
     median_kb = np.median(file_sizes_kb)
-    min_kb = np.min(file_sizes_kb)
-    max_kb = np.max(file_sizes_kb)
-    std_kb = np.std(file_sizes_kb)
+    min_kb = file_sizes_kb.min()
+    max_kb = file_sizes_kb.max()
+    std_kb = file_sizes_kb.std()
     
     print("FILE SIZE STATISTICS (ALL FILES):")
     print("-" * 60)
@@ -54,30 +72,37 @@ def plot_file_size_distribution(folder_path: Path, file_pattern: str = "*", remo
     lower_bound = mean_kb - 2 * std_kb
     upper_bound = mean_kb + 2 * std_kb
     
-    outliers_high = [(f, size_kb) for f, size_kb in zip(files, file_sizes_kb) if size_kb > upper_bound]
-    outliers_low = [(f, size_kb) for f, size_kb in zip(files, file_sizes_kb) if size_kb < lower_bound]
-    
-    # Print outliers
-    if outliers_high:
-        print(f"HIGH OUTLIERS (> 2 std dev, > {upper_bound:.2f} KB): {len(outliers_high)} files")
-        for file, size_kb in sorted(outliers_high, key=lambda x: x[1], reverse=True)[:5]:
-            print(f"  {file.name}: {size_kb:.2f} KB ({size_kb/1024:.2f} MB)")
-        if len(outliers_high) > 5:
-            print(f"  ... and {len(outliers_high) - 5} more")
+    high_mask = file_sizes_kb > upper_bound
+    low_mask = file_sizes_kb < lower_bound
+    num_high = int(np.count_nonzero(high_mask))
+    num_low = int(np.count_nonzero(low_mask))
+    has_outliers = num_high > 0 or num_low > 0
+    names = np.array([name for name, _ in files], dtype=object)
+    
+    # Print outliers (the top 5 are selected, not sorted out of all of them)
+    if num_high:
+        print(f"HIGH OUTLIERS (> 2 std dev, > {upper_bound:.2f} KB): {num_high} files")
+        high_names, high_sizes = names[high_mask], file_sizes_kb[high_mask]
+        for i in _smallest_k(-high_sizes):
+            print(f"  {high_names[i]}: {high_sizes[i]:.2f} KB ({high_sizes[i]/1024:.2f} MB)")
+        if num_high > 5:
+            print(f"  ... and {num_high - 5} more")
         print()
     
-    if outliers_low:
-        print(f"LOW OUTLIERS (< 2 std dev, < {lower_bound:.2f} KB): {len(outliers_low)} files")
-        for file, size_kb in sorted(outliers_low, key=lambda x: x[1])[:5]:
-            print(f"  {file.name}: {size_kb:.2f} KB ({size_kb/1024:.2f} MB)")
-        if len(outliers_low) > 5:
-            print(f"  ... and {len(outliers_low) - 5} more")
+    if num_low:
+        print(f"LOW OUTLIERS (< 2 std dev, < {lower_bound:.2f} KB): {num_low} files")
+        low_names, low_sizes = names[low_mask], file_sizes_kb[low_mask]
+        for i in _smallest_k(low_sizes):
+            print(f"  {low_names[i]}: {low_sizes[i]:.2f} KB ({low_sizes[i]/1024:.2f} MB)")
+        if num_low > 5:
+            print(f"  ... and {num_low - 5} more")
         print()
     
     # Filter data for plotting if remove_outliers is True
-    if remove_outliers and (outliers_high or outliers_low):
-        filtered_sizes_kb = [size for size in file_sizes_kb if lower_bound <= size <= upper_bound]
-        filtered_sizes_mb = [size / 1024 for size in filtered_sizes_kb]
+    if remove_outliers and has_outliers:
+        keep_mask = ~(high_mask | low_mask)
+        filtered_sizes_kb = file_sizes_kb[keep_mask]
+        filtered_sizes_mb = file_sizes_mb[keep_mask]
         
         print(f"PLOTTING WITH OUTLIERS REMOVED:")
         print(f"  Using {len(filtered_sizes_kb)}/{len(files)} files for visualization")
@@ -113,7 +138,7 @@ def plot_file_size_distribution(folder_path: Path, file_pattern: str = "*", remo
     ax1.grid(True, alpha=0.3)
     
     # ========== SORTED LINE PLOT ==========
-    sorted_sizes = sorted(sizes)
+    sorted_sizes = np.sort(sizes)
     ax2.plot(range(len(sorted_sizes)), sorted_sizes, linewidth=2, color='coral')
     ax2.axhline(np.mean(sizes), color='red', linestyle='--', linewidth=2, label=f'Mean: {np.mean(sizes):.2f} {unit}')
     ax2.axhline(np.median(sizes), color='green', linestyle='--', linewidth=2, label=f'Median: {np.median(sizes):.2f} {unit}')
@@ -127,7 +152,7 @@ def plot_file_size_distribution(folder_path: Path, file_pattern: str = "*", remo
     plt.tight_layout()
     
     # Save the plot
-    suffix = "_no_outliers" if remove_outliers and (outliers_high or outliers_low) else ""
+    suffix = "_no_outliers" if remove_outliers and has_outliers else ""
     output_file = folder_path.parent / f"{folder_path.name}_file_size_distribution{suffix}.png"
     plt.savefig(output_file, dpi=300, bbox_inches='tight')
     print(f"✓ Plot saved to: {output_file}")
@@ -1,10 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
 import os
+import sys
 import gzip
 import shutil
 import nibabel as nib
-import numpy as np
 from pathlib import Path
 from collections import defaultdict
+from label_utils import (find_centroid_json, label_cache_get, label_cache_put, labels_from_centroid_file,
+                         labels_from_centroids, link_or_copy, load_label_cache, present_labels, read_labels,
+                         save_label_cache)
 
 # ====================
 # CONFIGURATION
@@ -24,6 +28,16 @@ CERVICAL_LABELS = set(range(1, 8))  # 1-7
 THORACIC_LABELS = set(range(8, 11))  # 8-10
 
 DRY_RUN = False  # Set to False to actually copy files
+USE_CENTROID_JSON = True  # Take labels from VerSe centroid JSONs when present instead of scanning masks
+USE_LABEL_CACHE = True  # Reuse label sets from earlier runs for unchanged segmentation files
+
+# Per-directory cache of label sets, keyed on file name. Each entry records the
+# source of the labels ("mask" or "json") and is stamped with that source
+# file's (mtime, size). Its own file name and schema tag keep it apart from
+# VerSeCleaner_v3.py's cervical count cache, which can live in the same
+# segmentations directory
+_LABEL_CACHE_NAME = ".accept_all_cervical_labels.json"
+_LABEL_CACHE_SCHEMA = "accept_all_cervical_labels/2"
 
 
 # ====================
@@ -51,18 +65,39 @@ def gzip_file(input_path, output_path=None):
     return output_path
 
 
-def get_unique_labels(nii_file_path):
-    """Extract unique label values from a NIfTI segmentation file."""
+def get_unique_labels(nii_file_path, on_error=frozenset()):
+    """Extract unique label values from a NIfTI segmentation file (on_error if unreadable)."""
+    if USE_CENTROID_JSON:
+        labels = labels_from_centroids(Path(nii_file_path))
+        if labels is not None:
+            return labels
+    
     try:
         img = nib.load(nii_file_path)
-        data = img.get_fdata()
-        unique_labels = np.unique(data)
-        # Remove 0 (background) and convert to integers
-        unique_labels = set(int(label) for label in unique_labels if label > 0)
-        return unique_labels
+        data = read_labels(img)
+        # Background is already dropped; convert to plain ints
+        return set(int(label) for label in present_labels(data).tolist())
     except Exception as e:
         print(f"  ⚠️  Error reading {nii_file_path}: {e}")
-        return set()
+        return on_error
+
+
+def _labels_with_source(label_file, ctd_file):
+    """
+    Labels from ctd_file when given and usable, else from the mask.
+    Returns (labels, "json" or "mask"); labels is None on read errors.
+    """
+    if ctd_file is not None:
+        labels = labels_from_centroid_file(ctd_file)
+        if labels is not None:
+            return labels, "json"
+    
+    try:
+        img = nib.load(label_file)
+        return set(int(label) for label in present_labels(read_labels(img)).tolist()), "mask"
+    except Exception as e:
+        print(f"  ⚠️  Error reading {label_file}: {e}")
+        return None, "mask"
 
 
 def format_vertebrae_list(labels):
@@ -84,18 +119,29 @@ def meets_cervical_criteria(labels):
     if not labels:
         return False, "No labels found in segmentation file"
     
-    cervical_present = labels & CERVICAL_LABELS
-    thoracic_present = labels & THORACIC_LABELS
-    
-    num_cervical = len(cervical_present)
+    num_cervical = len(labels & CERVICAL_LABELS)
 
     # General rule: at least 3 cervical for each thoracic
     if num_cervical >= 3:
-        thoracic_names = format_vertebrae_list(thoracic_present)
+        # Thoracic labels only matter for the accept reason
+        thoracic_names = format_vertebrae_list(labels & THORACIC_LABELS)
         return True, f"{num_cervical} cervical ({', '.join(thoracic_names)})"
     else:
         return False, f"Insufficient cervical ({num_cervical}) need at least 3"
 
+def _copy_case(job):
+    """
+    Copy one accepted (label, volume) pair.
+    Returns None on success, else the exception.
+    """
+    label_file, dest_label_path, volume_file, dest_volume_path = job
+    try:
+        link_or_copy(label_file, dest_label_path)
+        link_or_copy(volume_file, dest_volume_path)
+        return None
+    except Exception as e:
+        return e
+
 # ====================
 # MAIN FILTERING ALGORITHM
 # ====================
@@ -136,64 +182,106 @@ def filter_and_copy_cervical_spine_data():
     label_files = list(labels_dir.glob("*.nii*"))
     stats["total_files"] += len(label_files)
     
-    for label_file in label_files:
+    # Reuse label sets from earlier runs for unchanged files
+    cache = load_label_cache(labels_dir, _LABEL_CACHE_NAME, _LABEL_CACHE_SCHEMA) if USE_LABEL_CACHE else {}
+    ctd_files = [find_centroid_json(label_file) if USE_CENTROID_JSON else None for label_file in label_files]
+    all_labels = []
+    for label_file, ctd_file in zip(label_files, ctd_files):
+        source = "mask" if ctd_file is None else "json"
+        hit = label_cache_get(cache, label_file.name, label_file if ctd_file is None else ctd_file)
+        all_labels.append(set(hit[0]) if hit and hit[1] == source else None)
+    
+    misses = [i for i, labels in enumerate(all_labels) if labels is None]
+    if USE_LABEL_CACHE:
+        print(f"Label cache hits: {len(label_files) - len(misses)}/{len(label_files)}")
+    
+    # Scan the rest up front; reads and decompression release the GIL, so
+    # the scans overlap. Results are reported below in file order
+    if misses:
+        with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+            results = executor.map(_labels_with_source, [label_files[i] for i in misses],
+                                   [ctd_files[i] for i in misses])
+            for i, (labels, source) in zip(misses, results):
+                if labels is None:
+                    all_labels[i] = set()  # Read errors aren't cached so they're retried next run
+                else:
+                    all_labels[i] = labels
+                    # Stamp with the file the labels actually came from
+                    label_cache_put(cache, label_files[i].name, ctd_files[i] if source == "json" else label_files[i],
+                                    [sorted(labels), source])
+        
+        if USE_LABEL_CACHE:
+            save_label_cache(labels_dir, _LABEL_CACHE_NAME, _LABEL_CACHE_SCHEMA, cache)
+    
+    # One listing of the volumes instead of exists() stats per file, and the
+    # destination directories built once rather than per accepted case
+    with os.scandir(volumes_dir) as entries:
+        volume_names = {e.name for e in entries}
+    dest_labels_dir = Path(DEST_LABELS)
+    dest_volumes_dir = Path(DEST_VOLUMES)
+    
+    copy_jobs = []
+    # Every label set is in hand, so build the report and write it once
+    log_lines = []
+    for label_file, labels in zip(label_files, all_labels):
         # Get corresponding volume file (remove _seg suffix)
         volume_name = label_file.name.replace("_seg", "")
-        volume_file = volumes_dir / volume_name
         
         # Alternative: try without any suffix modification
-        if not volume_file.exists():
-            volume_file = volumes_dir / label_file.name
+        source_volume_name = volume_name if volume_name in volume_names else label_file.name
         
-        print(f"\n📄 {label_file.name}")
+        log_lines.append(f"\n📄 {label_file.name}\n")
         
-        # Get labels from segmentation
-        labels = get_unique_labels(label_file)
         vertebrae = format_vertebrae_list(labels)
         
-        print(f"   Labels found: {sorted(labels)}")
-        print(f"   Vertebrae: {', '.join(vertebrae) if vertebrae else 'None'}")
+        log_lines.append(f"   Labels found: {sorted(labels)}\n")
+        log_lines.append(f"   Vertebrae: {', '.join(vertebrae) if vertebrae else 'None'}\n")
         
         # Check if meets criteria
         meets_criteria, reason = meets_cervical_criteria(labels)
         
         if meets_criteria:
-            print(f"   ✅ ACCEPTED: {reason}")
+            log_lines.append(f"   ✅ ACCEPTED: {reason}\n")
             stats["accepted"] += 1
             acceptance_reasons[reason] += 1
             
             # Check if volume file exists
-            if not volume_file.exists():
-                print(f"   ⚠️  Warning: Corresponding volume not found: {volume_name}")
+            if source_volume_name not in volume_names:
+                log_lines.append(f"   ⚠️  Warning: Corresponding volume not found: {volume_name}\n")
                 stats["missing_volume"] += 1
                 continue
             
             # Prepare destination file names with dataset prefix
-            dest_label_name = f"{label_file.name}"
-            dest_volume_name = f"{volume_name}"
-            
-            dest_label_path = Path(DEST_LABELS) / dest_label_name
-            dest_volume_path = Path(DEST_VOLUMES) / dest_volume_name
+            volume_file = volumes_dir / source_volume_name
+            dest_label_path = dest_labels_dir / label_file.name
+            dest_volume_path = dest_volumes_dir / volume_name
             
             # Copy files
             if DRY_RUN:
-                print(f"   [DRY RUN] Would copy:")
-                print(f"      {label_file} → {dest_label_path}")
-                print(f"      {volume_file} → {dest_volume_path}")
+                log_lines.append(f"   [DRY RUN] Would copy:\n")
+                log_lines.append(f"      {label_file} → {dest_label_path}\n")
+                log_lines.append(f"      {volume_file} → {dest_volume_path}\n")
             else:
-                try:
-                    shutil.copy2(label_file, dest_label_path)
-                    shutil.copy2(volume_file, dest_volume_path)
-                    print(f"   📋 Copied label: {dest_label_name}")
-                    print(f"   📋 Copied volume: {dest_volume_name}")
-                    stats["copied"] += 2
-                except Exception as e:
-                    print(f"   ⚠️  Error copying files: {e}")
-                    stats["errors"] += 1
+                # Copied together after the scan loop
+                copy_jobs.append((label_file, dest_label_path, volume_file, dest_volume_path))
         else:
-            print(f"   ❌ REJECTED: {reason}")
+            log_lines.append(f"   ❌ REJECTED: {reason}\n")
             stats["rejected"] += 1
             rejection_reasons[reason] += 1
+    sys.stdout.write("".join(log_lines))
+    
+    # Copies are I/O-bound, so overlap them; results are printed in file order
+    if copy_jobs:
+        print(f"\n📋 Copying {len(copy_jobs)} accepted cases...")
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for (label_file, dest_label_path, _, dest_volume_path), error in zip(copy_jobs, executor.map(_copy_case, copy_jobs)):
+                if error is None:
+                    sys.stdout.write(f"   📋 Copied label: {dest_label_path.name}\n"
+                                     f"   📋 Copied volume: {dest_volume_path.name}\n")
+                    stats["copied"] += 2
+                else:
+                    print(f"   ⚠️  Error copying files for {label_file.name}: {error}")
+                    stats["errors"] += 1
     
     # Final summary
     print("\n" + "=" * 80)
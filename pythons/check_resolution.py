@@ -1,8 +1,10 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import fnmatch
+import gzip
 import nibabel as nib
 import numpy as np
 from pathlib import Path
-import pandas as pd
-import shutil
 
 SLICE_THICKNESS_THRESHOLD_MM = 0.625  # mm
 DRY_RUN = True  # Set to False to actually delete files
@@ -10,8 +12,12 @@ PREFIX = "VerSe" # Dataset prefix used in filenames
 
 def get_nifti_metadata(file_path):
     """Extract key metadata from NIfTI file."""
-    img = nib.load(file_path)
-    header = img.header
+    # Only the header is needed: parse it straight from the (decompressed)
+    # stream, which inflates just the first few hundred bytes, instead of
+    # building a full image with a data proxy
+    opener = gzip.open if file_path.name.endswith('.gz') else open
+    with opener(file_path, 'rb') as f:
+        header = nib.Nifti1Header.from_fileobj(f)
     # Use header.get_data_shape() to obtain the image shape without requiring
     # the high-level attribute .shape on the image object.
     shape = header.get_data_shape()
@@ -30,6 +36,75 @@ def get_nifti_metadata(file_path):
         'file_size_mb': file_path.stat().st_size / (1024 * 1024)
     }
 
+def _analyze_case(vol_file, seg_folder):
+    """Metadata for one volume plus its segmentation's path and existence."""
+    # Extract case number from filename (e.g., {PREFIX}_001_0000.nii.gz -> 001)
+    case_num = vol_file.stem.split('_')[1]
+    seg_file = seg_folder / f"{PREFIX}_{case_num}.nii.gz"
+    
+    # Get metadata
+    metadata = get_nifti_metadata(vol_file)
+    metadata['case_num'] = case_num
+    metadata['vol_path'] = vol_file
+    metadata['seg_path'] = seg_file
+    metadata['seg_exists'] = seg_file.exists()
+    return metadata
+
+def _renumber_pairs(plan):
+    """
+    Rename each (old_vol, old_seg) to (new_vol, new_seg) in a single pass.
+    
+    A pair moves as soon as neither target still belongs to a pair that hasn't
+    moved yet; only pairs caught in a rename cycle take a TEMP_ hop.
+    Returns the number of pairs renamed.
+    """
+    # Paths still held by a source that hasn't been moved yet
+    pending = {path for old_vol, old_seg, _, _ in plan for path in (old_vol, old_seg)}
+    queue = list(plan)
+    renamed_count = 0
+    
+    while queue:
+        deferred = []
+        for old_vol, old_seg, new_vol, new_seg in queue:
+            if (new_vol != old_vol and new_vol in pending) or (new_seg != old_seg and new_seg in pending):
+                deferred.append((old_vol, old_seg, new_vol, new_seg))
+                continue
+            
+            try:
+                # os.replace is a single same-filesystem rename on every OS
+                for old, new in ((old_vol, new_vol), (old_seg, new_seg)):
+                    if old != new and old.exists():
+                        os.replace(old, new)
+                
+                renamed_count += 1
+                print(f"  ✓ Renamed to: {new_vol.name}")
+            except Exception as e:
+                print(f"  ❌ Error renaming: {e}")
+            pending.discard(old_vol)
+            pending.discard(old_seg)
+        
+        if deferred and len(deferred) == len(queue):
+            # Every remaining pair waits on another one: break the cycle by
+            # parking the first pair under TEMP_ names
+            old_vol, old_seg, new_vol, new_seg = deferred[0]
+            temp_vol = old_vol.with_name(f"TEMP_{old_vol.name}")
+            temp_seg = old_seg.with_name(f"TEMP_{old_seg.name}")
+            try:
+                if old_vol.exists():
+                    os.replace(old_vol, temp_vol)
+                if old_seg.exists():
+                    os.replace(old_seg, temp_seg)
+                deferred[0] = (temp_vol, temp_seg, new_vol, new_seg)
+            except Exception as e:
+                print(f"  ❌ Error creating temp file: {e}")
+                deferred.pop(0)
+            pending.discard(old_vol)
+            pending.discard(old_seg)
+        
+        queue = deferred
+    
+    return renamed_count
+
 def purge_and_renumber_dataset(base_path):
     """
     Remove low-quality files (thick slices) and renumber remaining files sequentially.
@@ -51,41 +126,31 @@ def purge_and_renumber_dataset(base_path):
     print()
     
     # Collect all volume files with metadata
-    vol_files = sorted(vol_folder.glob(f"{PREFIX}_*_0000.nii.gz"))
+    # One scandir pass with name matching; Paths are made only for matches
+    with os.scandir(vol_folder) as entries:
+        vol_files = sorted(Path(e.path) for e in entries
+                           if fnmatch.fnmatch(e.name, f"{PREFIX}_*_0000.nii.gz") and e.is_file())
     
     if not vol_files:
         print("ERROR: No volume files found!")
         # Return empty structures so callers can safely unpack the result
-        return pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+        return [], [], []
     
     print(f"Found {len(vol_files)} volume files")
     print()
     
-    # Analyze each file
-    file_data = []
-    for vol_file in vol_files:
-        # Extract case number from filename (e.g., {PREFIX}_001_0000.nii.gz -> 001)
-        case_num = vol_file.stem.split('_')[1]
-        seg_file = seg_folder / f"{PREFIX}_{case_num}.nii.gz"
-        
-        # Get metadata
-        metadata = get_nifti_metadata(vol_file)
-        metadata['case_num'] = case_num
-        metadata['vol_path'] = vol_file
-        metadata['seg_path'] = seg_file
-        metadata['seg_exists'] = seg_file.exists()
-        
-        file_data.append(metadata)
-    
-    df = pd.DataFrame(file_data)
+    # Analyze each file; header reads and stats are I/O-bound, so run them
+    # on a thread pool (map keeps the sorted file order)
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        file_data = list(executor.map(_analyze_case, vol_files, [seg_folder] * len(vol_files)))
     
-    # Identify files to remove
-    files_to_remove = df[df['slice_thickness'] > SLICE_THICKNESS_THRESHOLD_MM]
-    files_to_keep = df[df['slice_thickness'] <= SLICE_THICKNESS_THRESHOLD_MM]
+    # Identify files to remove (plain lists of the per-file dicts, in file order)
+    files_to_remove = [d for d in file_data if d['slice_thickness'] > SLICE_THICKNESS_THRESHOLD_MM]
+    files_to_keep = [d for d in file_data if d['slice_thickness'] <= SLICE_THICKNESS_THRESHOLD_MM]
     
     print("ANALYSIS:")
     print("-" * 100)
-    print(f"Total files: {len(df)}")
+    print(f"Total files: {len(file_data)}")
     print(f"Files to REMOVE (slice thickness >{SLICE_THICKNESS_THRESHOLD_MM}mm): {len(files_to_remove)}")
     print(f"Files to KEEP: {len(files_to_keep)}")
     print()
@@ -93,14 +158,14 @@ def purge_and_renumber_dataset(base_path):
     if len(files_to_remove) > 0:
         print("FILES TO BE REMOVED:")
         print("-" * 100)
-        for idx, row in files_to_remove.iterrows():
+        for row in files_to_remove:
             print(f"  ❌ {row['filename']} - Resolution: {row['resolution']}")
         print()
     
     if len(files_to_keep) > 0:
         print("FILES TO BE KEPT & RENUMBERED:")
         print("-" * 100)
-        for new_idx, (old_idx, row) in enumerate(files_to_keep.iterrows(), start=1):
+        for new_idx, row in enumerate(files_to_keep, start=1):
             old_name = row['filename']
             new_vol_name = f"{PREFIX}_{new_idx:03d}_0000.nii.gz"
             new_seg_name = f"{PREFIX}_{new_idx:03d}.nii.gz"
@@ -114,7 +179,7 @@ def purge_and_renumber_dataset(base_path):
         print("=" * 100)
         print("To actually delete and renumber files, run with DRY_RUN=False")
         print()
-        return df, files_to_remove, files_to_keep
+        return file_data, files_to_remove, files_to_keep
     
     # === ACTUAL DELETION AND RENAMING ===
     print("=" * 100)
@@ -125,7 +190,7 @@ def purge_and_renumber_dataset(base_path):
     # Step 1: Delete files
     print("Step 1: Deleting low-quality files...")
     deleted_count = 0
-    for idx, row in files_to_remove.iterrows():
+    for row in files_to_remove:
         vol_path = row['vol_path']
         seg_path = row['seg_path']
         
@@ -144,55 +209,15 @@ def purge_and_renumber_dataset(base_path):
     print(f"\nDeleted {deleted_count} volume files and their segmentations")
     print()
     
-    # Step 2: Rename remaining files to temporary names first (to avoid conflicts)
-    print("Step 2: Renaming files to temporary names...")
-    temp_mapping = []
-    for idx, row in files_to_keep.iterrows():
-        vol_path = row['vol_path']
-        seg_path = row['seg_path']
-        
-        temp_vol_name = f"TEMP_{row['case_num']}_0000.nii.gz"
-        temp_seg_name = f"TEMP_{row['case_num']}.nii.gz"
-        
-        temp_vol_path = vol_folder / temp_vol_name
-        temp_seg_path = seg_folder / temp_seg_name
-        
-        try:
-            if vol_path.exists():
-                shutil.move(str(vol_path), str(temp_vol_path))
-            if seg_path.exists():
-                shutil.move(str(seg_path), str(temp_seg_path))
-            
-            temp_mapping.append({
-                'temp_vol': temp_vol_path,
-                'temp_seg': temp_seg_path
-            })
-        except Exception as e:
-            print(f"  ❌ Error creating temp file: {e}")
-    
-    print(f"  ✓ Moved {len(temp_mapping)} pairs to temporary names")
-    print()
-    
-    # Step 3: Rename to final sequential numbers
-    print("Step 3: Renumbering to sequential format...")
-    renamed_count = 0
-    for new_idx, temp_files in enumerate(temp_mapping, start=1):
-        new_vol_name = f"{PREFIX}_{new_idx:03d}_0000.nii.gz"
-        new_seg_name = f"{PREFIX}_{new_idx:03d}.nii.gz"
-
-        final_vol_path = vol_folder / new_vol_name
-        final_seg_path = seg_folder / new_seg_name
-        
-        try:
-            if temp_files['temp_vol'].exists():
-                shutil.move(str(temp_files['temp_vol']), str(final_vol_path))
-            if temp_files['temp_seg'].exists():
-                shutil.move(str(temp_files['temp_seg']), str(final_seg_path))
-            
-            renamed_count += 1
-            print(f"  ✓ Renamed to: {new_vol_name}")
-        except Exception as e:
-            print(f"  ❌ Error renaming: {e}")
+    # Step 2: Rename straight to final sequential numbers; temp names are only
+    # used where renames would otherwise collide in a cycle
+    print("Step 2: Renumbering to sequential format...")
+    plan = []
+    for new_idx, row in enumerate(files_to_keep, start=1):
+        plan.append((row['vol_path'], row['seg_path'],
+                     vol_folder / f"{PREFIX}_{new_idx:03d}_0000.nii.gz",
+                     seg_folder / f"{PREFIX}_{new_idx:03d}.nii.gz"))
+    renamed_count = _renumber_pairs(plan)
     
     print()
     print("=" * 100)
@@ -203,7 +228,7 @@ def purge_and_renumber_dataset(base_path):
     print(f"Final dataset size: {renamed_count} cases")
     print()
     
-    return df, files_to_remove, files_to_keep
+    return file_data, files_to_remove, files_to_keep
 
 if __name__ == "__main__":
     base_path = Path("C:\\Users\\anoma\\Downloads\\spine-segmentation-data-cleaning\\VerSe_clean_v3")
@@ -211,7 +236,7 @@ if __name__ == "__main__":
     # STEP 1: DRY RUN (preview what will be deleted)
     print("\n🔍 RUNNING DRY RUN - NO FILES WILL BE DELETED")
     print()
-    df, to_remove, to_keep = purge_and_renumber_dataset(base_path)
+    file_data, to_remove, to_keep = purge_and_renumber_dataset(base_path)
     
     # STEP 2: Ask for confirmation
     print()
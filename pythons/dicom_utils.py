@@ -0,0 +1,77 @@
+import os
+from pathlib import Path
+import shutil
+import zipfile
+
+# DICOM archive helpers shared by the Duke conversion scripts in this folder.
+# Like label_utils, this module is found next to the scripts that import it.
+
+# Zip members that are never DICOM slices (metadata, previews, reports)
+_NON_DICOM_SUFFIXES = ('.xml', '.txt', '.json', '.html', '.jpg', '.jpeg', '.png', '.bmp')
+_COPY_BUFFER_SIZE = 1 << 20  # 1 MiB
+
+
+def is_dicom_member(info: zipfile.ZipInfo) -> bool:
+    """
+    Decide from the zip index alone whether a member is worth extracting.
+    """
+    if info.is_dir() or '__MACOSX/' in info.filename:
+        return False
+    name = info.filename.rsplit('/', 1)[-1]
+    if not name or name.startswith('.') or name.upper() == 'DICOMDIR':
+        return False
+    return not name.lower().endswith(_NON_DICOM_SUFFIXES)
+
+
+def extract_dicom_members(zip_ref: zipfile.ZipFile, dest_dir: Path, prefix: str = None) -> int:
+    """
+    Stream only the DICOM members of an open zip directly into dest_dir.
+    By default the archive's folder layout is kept; with a prefix it is
+    flattened into the file name (prefixed with prefix) so every slice
+    sits in one folder.
+    Returns the number of files written.
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    written = 0
+    for info in zip_ref.infolist():
+        if not is_dicom_member(info):
+            continue
+        
+        # Same sanitising as extractall: drop empty, '.' and '..' components
+        parts = [p for p in info.filename.replace('\\', '/').split('/') if p not in ('', '.', '..')]
+        if prefix is None:
+            dest = os.path.join(dest_dir, *parts)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+        else:
+            dest = os.path.join(dest_dir, prefix + '_'.join(parts))
+        
+        with zip_ref.open(info) as src, open(dest, 'wb') as dst:
+            shutil.copyfileobj(src, dst, length=_COPY_BUFFER_SIZE)
+        written += 1
+    
+    return written
+
+
+def extract_one_zip(zip_file: Path, dest_dir: Path, prefix: str = None):
+    """
+    Extract one archive with its own ZipFile handle (handles are not
+    thread-safe to share). Returns (zip_file, extracted_count, error).
+    """
+    try:
+        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+            return zip_file, extract_dicom_members(zip_ref, dest_dir, prefix), None
+    except Exception as e:
+        return zip_file, 0, e
+
+
+def resolve_temp_root(temp_root: str = None) -> str:
+    """
+    Pick where per-case extraction happens. An explicit temp_root wins;
+    otherwise use RAM-backed /dev/shm when it exists (Linux) so extracted
+    slices never hit disk. None means the system default temp dir.
+    """
+    if temp_root:
+        return str(temp_root)
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return None
@@ -1,30 +1,56 @@
+from concurrent.futures import ProcessPoolExecutor
 import os
 import gzip
 import shutil
+import subprocess
+
+# pigz compresses one file on all cores; without it, files are spread over
+# worker processes instead
+_PIGZ = shutil.which('pigz')
+
+def _compress(input_path):
+    """
+    Gzip input_path to input_path + '.gz' (level 6) and remove the original.
+    """
+    if _PIGZ is not None:
+        # -f overwrites a stale .gz; pigz removes the original once it's written
+        subprocess.run([_PIGZ, '-f', '-6', input_path], check=True)
+        return
+    
+    with open(input_path, 'rb') as f_in:
+        with gzip.open(input_path + '.gz', 'wb', compresslevel=6) as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+    
+    os.remove(input_path)
 
 def compress_nii_files(folder):
     compressed_count = 0
+    to_compress = []
     
     for root, dirs, files in os.walk(folder):
         print(f"\nSearching in: {root}")
         
         for file in files:
             if file.endswith('.nii') and not file.endswith('.nii.gz'):
-                input_path = os.path.join(root, file)
-                output_path = input_path + '.gz'
-                
-                print(f"  Compressing: {file}")
-                
-                with open(input_path, 'rb') as f_in:
-                    with gzip.open(output_path, 'wb') as f_out:
-                        shutil.copyfileobj(f_in, f_out)
-                
-                os.remove(input_path)
-                compressed_count += 1
-                print(f"  ✓ Created: {file}.gz")
+                to_compress.append(os.path.join(root, file))
             else:
                 print(f"  Skipping: {file}")
     
+    if _PIGZ is not None:
+        # pigz already uses every core on each file, so run it in-process
+        # one file at a time
+        for input_path in to_compress:
+            _compress(input_path)
+            compressed_count += 1
+            print(f"  ✓ Created: {os.path.basename(input_path)}.gz")
+    else:
+        # zlib is single-threaded, so each worker process compresses its own
+        # file. Results come back in walk order
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for input_path, _ in zip(to_compress, executor.map(_compress, to_compress)):
+                compressed_count += 1
+                print(f"  ✓ Created: {os.path.basename(input_path)}.gz")
+    
     print(f"\n{'='*60}")
     print(f"Compression completed: {compressed_count} files")
     print(f"{'='*60}")
@@ -35,4 +61,4 @@ if __name__ == "__main__":
     if not os.path.exists(folder_path):
         print(f"ERROR: Folder not found: {folder_path}")
     else:
-        compress_nii_files(folder_path)
\ No newline at end of file
+        compress_nii_files(folder_path)
@@ -1,5 +1,7 @@
+import os
 from pathlib import Path
 import shutil
+from label_utils import link_or_copy
 
 def copy_corresponding_labels(images_dir: Path, labels_source_dirs: list[Path], labels_dest_dir: Path):
     """
@@ -7,33 +9,38 @@ def copy_corresponding_labels(images_dir: Path, labels_source_dirs: list[Path],
     """
     labels_dest_dir.mkdir(parents=True, exist_ok=True)
     
-    # Get all image files
-    image_files = sorted(images_dir.glob("*_0000.nii.gz"))
+    # Get all image file names (one scandir pass, no Path per entry)
+    with os.scandir(images_dir) as entries:
+        image_names = sorted(e.name for e in entries if e.name.endswith("_0000.nii.gz") and e.is_file())
     
-    print(f"Found {len(image_files)} image files in {images_dir.name}")
+    print(f"Found {len(image_names)} image files in {images_dir.name}")
     print(f"Searching for corresponding labels...\n")
     
+    # Index every source directory once; the first source listing a label
+    # wins, same as searching them in order
+    label_index = {}
+    for labels_source in labels_source_dirs:
+        if not labels_source.is_dir():
+            continue
+        with os.scandir(labels_source) as entries:
+            for e in entries:
+                if e.name.endswith(".nii.gz"):
+                    label_index.setdefault(e.name, e.path)
+    
     found_count = 0
     missing_count = 0
     
-    for img_file in image_files:
+    for img_name in image_names:
         # Get case ID by removing _0000.nii.gz suffix
-        case_id = img_file.name.replace("_0000.nii.gz", "")
+        case_id = img_name.replace("_0000.nii.gz", "")
         label_name = f"{case_id}.nii.gz"
         
-        # Search for label in all source directories
-        found = False
-        for labels_source in labels_source_dirs:
-            label_path = labels_source / label_name
-            
-            if label_path.exists():
-                shutil.copy2(label_path, labels_dest_dir / label_name)
-                found_count += 1
-                found = True
-                print(f"  ✓ Copied: {label_name}")
-                break
-        
-        if not found:
+        label_path = label_index.get(label_name)
+        if label_path is not None:
+            link_or_copy(label_path, labels_dest_dir / label_name, shutil.copy2)
+            found_count += 1
+            print(f"  ✓ Copied: {label_name}")
+        else:
             missing_count += 1
             print(f"  ✗ Missing: {label_name}")
     
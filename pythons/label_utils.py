@@ -0,0 +1,263 @@
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import json
+import os
+from pathlib import Path
+import re
+import shutil
+import subprocess
+import numpy as np
+
+# Helpers shared by the cleaner scripts in this folder. The scripts are run
+# directly (python pythons/<script>.py), so this module is found next to them.
+
+# Multi-threaded gzip for the .nii -> .nii.gz outputs; None means fall back to zlib
+_PIGZ = shutil.which('pigz')
+
+# VerSe file name patterns (compiled once)
+_SUB_RE = re.compile(r'sub-(gl\d+|verse\d+)')
+_SPLIT_RE = re.compile(r'split-verse(\d+)')
+_LEGACY_RE = re.compile(r'(GL|verse)(\d+)', re.IGNORECASE)
+
+
+def read_labels(img) -> np.ndarray:
+    """
+    Read label voxels in their stored dtype (no float64 upcast like get_fdata).
+    Only falls back to get_fdata when the header actually scales the data.
+    """
+    slope = getattr(img.dataobj, 'slope', 1.0)
+    inter = getattr(img.dataobj, 'inter', 0.0)
+    if slope == 1 and inter == 0:
+        return np.asarray(img.dataobj)
+    return np.rint(img.get_fdata()).astype(np.int32)
+
+
+def label_histogram(data: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Every label present in a label volume (background included), ascending,
+    with its voxel count. Small non-negative integer labels are counted with
+    one bincount pass (no sort); anything else falls back to np.unique.
+    """
+    flat = data.reshape(-1)
+    if flat.dtype.kind in 'iu' and flat.size and flat.min() >= 0 and flat.max() < 2**16:
+        counts = np.bincount(flat.astype(np.int64, copy=False))
+        labels = np.nonzero(counts)[0]
+        return labels, counts[labels]
+    return np.unique(flat, return_counts=True)
+
+
+def present_labels(data: np.ndarray) -> np.ndarray:
+    """Non-background labels present in a label volume, ascending."""
+    labels, _ = label_histogram(data)
+    return labels[labels > 0]
+
+
+def quick_reject(img, max_label: int, depth: int = 8):
+    """
+    Peek at the first and last `depth` z-slices of an uncompressed 3D label
+    volume. Out-of-range vertebrae (lumbar/lower thoracic) sit at one end of
+    the stack, so most rejects are decided here without reading the rest.
+    
+    Returns the max label seen if it exceeds max_label, else None.
+    """
+    z = img.shape[2]
+    head = np.asarray(img.dataobj[..., :min(depth, z)])
+    tail = np.asarray(img.dataobj[..., max(0, z - depth):z])
+    max_seen = max(head.max(initial=0), tail.max(initial=0))
+    return max_seen if max_seen > max_label else None
+
+
+def scan_labels_by_slab(img, max_label: int, slab_depth: int = 32):
+    """
+    Read an uncompressed 3D label volume slab_depth z-slices at a time
+    through the dataobj proxy, collecting the labels present. Stops at
+    the first slab whose max exceeds max_label.
+    
+    Returns (labels_present, max_seen); labels_present is None if rejected.
+    """
+    presence = np.zeros(max_label + 1, dtype=bool)
+    max_seen = 0
+    for z0 in range(0, img.shape[2], slab_depth):
+        slab = np.asarray(img.dataobj[..., z0:z0 + slab_depth])
+        max_seen = max(max_seen, slab.max())
+        if max_seen > max_label:
+            return None, max_seen  # Already invalid, skip the rest of the volume
+        presence[present_labels(slab).astype(np.intp)] = True
+    return np.nonzero(presence)[0], max_seen
+
+
+def find_centroid_json(seg_file: Path):
+    """
+    The VerSe centroid JSON next to a mask (sub-xxx_seg-subreg_ctd.json for
+    sub-xxx_seg-vert_msk.nii.gz, else <stem>.json), or None if neither exists.
+    """
+    stem = seg_file.name.replace('.nii.gz', '').replace('.nii', '')
+    candidates = [stem + '.json']
+    if '_seg-vert_msk' in stem:
+        candidates.insert(0, stem.replace('_seg-vert_msk', '_seg-subreg_ctd') + '.json')
+    
+    for name in candidates:
+        ctd_file = seg_file.with_name(name)
+        if ctd_file.is_file():
+            return ctd_file
+    return None
+
+
+def labels_from_centroid_file(ctd_file: Path):
+    """Vertebra labels listed in a VerSe centroid JSON, or None if it isn't usable."""
+    try:
+        with open(ctd_file) as f:
+            centroids = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(centroids, list):
+        return None
+    labels = {int(c['label']) for c in centroids if isinstance(c, dict) and 'label' in c}
+    return labels or None
+
+
+def labels_from_centroids(seg_file: Path):
+    """
+    Vertebra labels listed in the VerSe centroid JSON next to a mask, so the
+    volume doesn't have to be decompressed. Returns None if there is no
+    usable JSON.
+    """
+    ctd_file = find_centroid_json(seg_file)
+    return labels_from_centroid_file(ctd_file) if ctd_file is not None else None
+
+
+def extract_verse_subject_info(filename: str) -> dict:
+    """
+    Extract subject ID and split ID from various VerSe naming conventions.
+    Returns {'subject_id': str, 'split_id': str or None}
+    """
+    # Standard format: sub-{id}_split-{split}_ct.nii or sub-{id}_ct.nii
+    match = _SUB_RE.search(filename)
+    if match:
+        subject_id = match.group(1)
+        split_match = _SPLIT_RE.search(filename)
+        split_id = split_match.group(1) if split_match else None
+        return {'subject_id': subject_id, 'split_id': split_id}
+    
+    # Legacy format: GL{number}_CT or verse{number}_CT
+    legacy_match = _LEGACY_RE.search(filename)
+    if legacy_match:
+        prefix = legacy_match.group(1).lower()
+        number = legacy_match.group(2)
+        subject_id = f"{prefix}{number}"
+        return {'subject_id': subject_id, 'split_id': None}
+    
+    return {'subject_id': None, 'split_id': None}
+
+
+def link_or_copy(src, dst, copy_function=shutil.copyfile):
+    """
+    Hardlink src to dst (O(1), only works when input and output are on the
+    same filesystem); otherwise fall back to copy_function. The default,
+    shutil.copyfile, skips copy2's permission/timestamp syscalls, which
+    outputs that are only read back by nnUNet don't need.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            return  # Already linked by an earlier run
+        copy_function(src, dst)
+
+
+def load_label_cache(directory, cache_name: str, schema: str) -> dict:
+    """
+    Load a per-directory cache written by save_label_cache. Entries map a
+    key to [st_mtime_ns, st_size, value]; a missing or unreadable file, or
+    one written under a different schema tag, gives an empty cache.
+    """
+    try:
+        with open(Path(directory) / cache_name) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get("schema") != schema:
+        return {}
+    return data.get("entries", {})
+
+
+def label_cache_get(cache: dict, key: str, path: Path):
+    """
+    Return the cached value for key, or None if it was never stored or
+    path has changed (different mtime or size) since.
+    """
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    st = path.stat()
+    if entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+        return entry[2]
+    return None
+
+
+def label_cache_put(cache: dict, key: str, path: Path, value):
+    """
+    Store value for key, stamped with path's current mtime and size.
+    A None value (read error) isn't stored, so it's retried next run.
+    """
+    if value is None:
+        return
+    st = path.stat()
+    cache[key] = [st.st_mtime_ns, st.st_size, value]
+
+
+def save_label_cache(directory, cache_name: str, schema: str, cache: dict):
+    """
+    Write the cache atomically (temp file + rename), tagged with schema,
+    creating directory if needed; a read-only directory only costs a warning.
+    """
+    cache_path = Path(directory) / cache_name
+    tmp_path = cache_path.with_name(cache_name + ".tmp")
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp_path, "w") as f:
+            json.dump({"schema": schema, "entries": cache}, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"WARNING: Could not write label cache: {e}")
+
+
+def write_gz(src: Path, dst: Path, threads: int = 1):
+    """
+    Write src to dst as gzip. Already-gzipped sources are linked/copied
+    as-is; raw .nii sources are compressed at level 1 with `threads` pigz
+    threads, or with single-threaded zlib when pigz isn't installed.
+    """
+    if str(src).endswith('.gz'):
+        link_or_copy(src, dst, shutil.copy2)
+        return
+    
+    # dst may be a hardlink to src from an older run - never write through it
+    dst.unlink(missing_ok=True)
+    if _PIGZ is not None:
+        with open(dst, 'wb') as f_out:
+            subprocess.run([_PIGZ, '-p', str(threads), '-1', '-c', str(src)], stdout=f_out, check=True)
+    else:
+        with open(src, 'rb') as f_in, gzip.open(dst, 'wb', compresslevel=1) as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+
+
+def _write_case_gz(pair: dict, case_id: str, images_dir: Path, labels_dir: Path, gzip_threads: int) -> str:
+    """Write one case's volume and segmentation as .nii.gz under its nnUNet names."""
+    write_gz(pair['volume'], images_dir / f"{case_id}_0000.nii.gz", gzip_threads)
+    write_gz(pair['segmentation'], labels_dir / f"{case_id}.nii.gz", gzip_threads)
+    return case_id
+
+
+def write_cases_gz(pairs: list[dict], case_ids: list[str], images_dir: Path, labels_dir: Path, workers: int = 8):
+    """
+    Write every pair's volume/segmentation as {case_id}_0000.nii.gz and
+    {case_id}.nii.gz, yielding each case_id in input order once it's done.
+    Copies are I/O-bound (the GIL is released during file I/O), so they run
+    on `workers` threads; the cores are shared between their pigz processes.
+    """
+    n = len(pairs)
+    gzip_threads = max(1, (os.cpu_count() or 1) // workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(_write_case_gz, pairs, case_ids, [images_dir] * n, [labels_dir] * n,
+                                [gzip_threads] * n)
@@ -148,9 +148,8 @@ def process_file_to_sanctuary(input_path, output_path, threshold=1.0,
     Returns:
         stats: Dictionary with processing statistics
     """
-    # Load NIfTI file
+    # Load NIfTI header only; voxels are read below if resampling is needed
     img = nib.load(input_path)
-    img_data = img.get_fdata()
     original_affine = img.affine
     
     # Get original spacing
@@ -166,7 +165,7 @@ def process_file_to_sanctuary(input_path, output_path, threshold=1.0,
         'file_type': file_type,
         'original_spacing': original_spacing,
         'target_spacing': target_spacing,
-        'original_shape': img_data.shape,
+        'original_shape': img.shape,
         'needs_resampling': needs_resampling,
         'dimensions_fixed': []
     }
@@ -182,9 +181,16 @@ def process_file_to_sanctuary(input_path, output_path, threshold=1.0,
         output_path.parent.mkdir(parents=True, exist_ok=True)
         shutil.copy2(input_path, output_path)
         stats['action'] = 'COPIED (already good)'
-        stats['new_shape'] = img_data.shape
+        stats['new_shape'] = img.shape
         return stats
     
+    if file_type == "label":
+        # Labels keep their stored integer dtype (nearest-neighbour resampling
+        # doesn't need float64, and the output stays an integer mask)
+        img_data = np.asarray(img.dataobj)
+    else:
+        img_data = img.get_fdata()
+    
     # Perform selective resampling
     resampled_data = selective_resample(img_data, zoom_factors, order=interpolation_order)
     
@@ -100,7 +100,7 @@ def load_segmentation(filepath=None):
     try:
         print(f"Loading segmentation from: {filepath}")
         nifti_img = nib.load(filepath)
-        segmentation = nifti_img.get_fdata()
+        segmentation = np.asarray(nifti_img.dataobj)  # stored label dtype, no float64 copy
         affine = nifti_img.affine
         print(f"Loaded: shape={segmentation.shape}, dtype={segmentation.dtype}")
         return segmentation, affine